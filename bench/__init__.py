@@ -0,0 +1 @@
+# benchmark scripts; run each from the repository root with python -m bench.<name>
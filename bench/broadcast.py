@@ -0,0 +1,61 @@
+""" Times broadcasting a public chat line to every connected user with HLServer.sendPacket, which flattens the packet
+once, against flattening it for each recipient (how sendPacket used to work). Also reports the memory held by one
+queued broadcast, using tracemalloc.
+
+    python -m bench.broadcast
+"""
+
+from bench.fakes import connect, makeServer
+from phxd.constants import *
+from phxd.packet import HLPacket
+
+import timeit
+import tracemalloc
+
+
+def chatPacket():
+    chat = HLPacket(HTLS_HDR_CHAT)
+    chat.addNumber(DATA_UID, 1)
+    chat.addString(DATA_STRING, "\r      someone:  " + "a line of chat " * 4)
+    return chat
+
+
+def flattenEach(conns, packet, immediate=True):
+    """ The broadcast before packets were flattened once per send. """
+    for conn in conns:
+        conn.writePacket(packet, immediate)
+
+
+def queuedBytes(send):
+    """ Returns the memory held by one broadcast while it is queued on every connection. """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    send()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+def main():
+    server = makeServer()
+    conns = []
+    print("%8s %16s %16s %14s %14s" % ("users", "once (ms)", "each (ms)", "once (bytes)", "each (bytes)"))
+    for users in (100, 1000, 2000, 5000):
+        conns += connect(server, users - len(conns))
+        packet = chatPacket()
+        once = min(timeit.repeat(lambda: server.sendPacket(packet, immediate=True), number=20, repeat=5)) / 20 * 1e3
+        each = min(timeit.repeat(lambda: flattenEach(conns, packet), number=20, repeat=5)) / 20 * 1e3
+        # Queue one broadcast first, so the pending flush calls already exist, then measure a second one.
+        server.sendPacket(packet)
+        onceBytes = queuedBytes(lambda: server.sendPacket(packet))
+        for conn in conns:
+            conn.discardOutgoing()
+        flattenEach(conns, packet, False)
+        eachBytes = queuedBytes(lambda: flattenEach(conns, packet, False))
+        for conn in conns:
+            conn.discardOutgoing()
+        print("%8d %16.3f %16.3f %14d %14d" % (users, once, each, onceBytes, eachBytes))
+
+
+if __name__ == "__main__":
+    main()
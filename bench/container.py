@@ -0,0 +1,65 @@
+""" Times HLContainer field lookups in large containers, such as a file list reply with thousands of DATA_FILE
+objects, using the type index against a scan of every object (how the getters used to work). Also reports the
+memory held by each parsed packet, index included, using tracemalloc.
+
+    python -m bench.container
+"""
+
+from phxd.constants import *
+from phxd.packet import HLPacket
+
+import timeit
+import tracemalloc
+
+
+def scanNumber(container, type):
+    """ The getNumber lookup before the type index: a scan of every object. """
+    for obj in container.objs:
+        if obj.type == type:
+            return obj.getNumber()
+    return None
+
+
+def build(size):
+    reply = HLPacket(HTLS_HDR_TASK)
+    for k in range(size):
+        reply.addBinary(DATA_FILE, bytes(20) + b'file %d' % k)
+    # Fields added after the file objects are the worst case for a scan.
+    reply.addNumber(DATA_XFERSIZE, 12345)
+    reply.addString(DATA_COMMENT, "comment")
+    parsed = HLPacket()
+    parsed.parse(reply.flatten())
+    return parsed
+
+
+def packetBytes(data, count=200):
+    """ Returns the bytes allocated per packet parsed from data, for packets that are kept around. """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    packets = []
+    for k in range(count):
+        packet = HLPacket()
+        packet.parse(data)
+        packets.append(packet)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used // count
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print("%8s %14s %14s %16s %16s" % ("objects", "index (us)", "scan (us)", "getObjects (us)", "bytes/packet"))
+    for size in (10, 100, 1000, 5000, 20000):
+        packet = build(size)
+        indexed = measure(lambda: packet.getNumber(DATA_XFERSIZE), 20000)
+        scanned = measure(lambda: scanNumber(packet, DATA_XFERSIZE), max(20, 200000 // size))
+        files = measure(lambda: packet.getObjects(DATA_FILE), max(20, 200000 // size))
+        held = packetBytes(packet.flatten(), max(2, 20000 // size))
+        print("%8d %14.3f %14.3f %16.3f %16d" % (size, indexed, scanned, files, held))
+
+
+if __name__ == "__main__":
+    main()
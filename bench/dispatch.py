@@ -0,0 +1,94 @@
+""" Times dispatching a received packet to one handler behind require_permission, and running the outgoing filters
+for a packet with and without a filter registered, through HLDispatchTable against PyDispatcher (how packets were
+dispatched before): a send for the generic signal and another for the typed one, with keyword arguments.
+
+    python -m bench.dispatch
+"""
+
+from pydispatch import dispatcher
+
+from bench.fakes import connect, makeServer
+from phxd.constants import *
+from phxd.packet import HLPacket
+from phxd.permissions import PRIV_SEND_CHAT
+from phxd.server.decorators import packet_filter, packet_handler, require_permission
+from phxd.server.dispatch import HLDispatchTable
+from phxd.server.signals import packet_outgoing, packet_received
+from phxd.types import HLException
+
+import timeit
+
+
+def requirePermissionKeywords(perm, action):
+    """ require_permission as it was when handlers were called by PyDispatcher. """
+    def _dec(handler_func):
+        def _checkperm(signal, sender, *args, **kwargs):
+            user = kwargs.get('user', None)
+            if user and not user.hasPriv(perm):
+                raise HLException("You do not have permission to %s." % action)
+            return handler_func(*args, **kwargs)
+        return _checkperm
+    return _dec
+
+
+@packet_handler(HTLC_HDR_CHAT)
+@require_permission(PRIV_SEND_CHAT, "participate in chat")
+def handleChat(server, user, packet):
+    pass
+
+
+@packet_filter(HTLS_HDR_CHAT)
+def filterChat(server, packet, users):
+    pass
+
+
+@requirePermissionKeywords(PRIV_SEND_CHAT, "participate in chat")
+def handleChatKeywords(server, user, packet):
+    pass
+
+
+def filterChatKeywords(server, packet, users):
+    pass
+
+
+def sendSignals(signal, ptype, **kwargs):
+    dispatcher.send(signal=signal, **kwargs)
+    dispatcher.send(signal=(signal, ptype), **kwargs)
+
+
+def filterTable(table, server, packet, users):
+    if table.hasFilters(packet.type):
+        table.filter(server, packet, users)
+
+
+def measure(func, number=100000):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    server = makeServer()
+    user = connect(server, 1)[0].context
+    users = [user]
+    table = HLDispatchTable()
+    table.connect(handleChat)
+    table.connect(filterChat)
+    dispatcher.connect(handleChatKeywords, signal=(packet_received, HTLC_HDR_CHAT))
+    dispatcher.connect(filterChatKeywords, signal=(packet_outgoing, HTLS_HDR_CHAT))
+    received = HLPacket(HTLC_HDR_CHAT)
+    filtered = HLPacket(HTLS_HDR_CHAT)
+    unfiltered = HLPacket(HTLS_HDR_MSG)
+    rows = [
+        ("inbound dispatch", lambda: table.dispatch(server, user, received),
+            lambda: sendSignals(packet_received, received.type, sender=server, server=server, user=user, packet=received)),
+        ("filtered outbound", lambda: filterTable(table, server, filtered, users),
+            lambda: sendSignals(packet_outgoing, filtered.type, sender=server, server=server, packet=filtered, users=users)),
+        ("unfiltered outbound", lambda: filterTable(table, server, unfiltered, users),
+            lambda: sendSignals(packet_outgoing, unfiltered.type, sender=server, server=server, packet=unfiltered, users=users)),
+    ]
+    print("%-22s %14s %14s" % ("", "table (us)", "dispatcher (us)"))
+    for (name, direct, signals) in rows:
+        print("%-22s %14.2f %14.2f" % (name, measure(direct), measure(signals, 20000)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+""" Measures download throughput over loopback through HLFileServer, using each download mode in turn: plain chunked
+reads, sendfile, chunked reads done ahead in the thread pool, and memory-mapped forks. Each mode runs in its own process, downloading a
+temporary file with one or more clients at once. Also reports how long the reactor went without running a 1 ms timer,
+which is how long every other client would have waited. With --cold, the file is dropped from the page cache first;
+--read-delay adds a sleep to every read, standing in for a slow disk or network mount. The peak resident memory of
+the server process is reported too, split into anonymous memory and mapped file pages, which the kernel can drop.
+With --tls, downloads go over TLS, where sendfile can't be used.
+
+    python -m bench.download [--size MB] [--clients N] [--cold] [--read-delay MS] [--tls] [--mode MODE]
+"""
+
+from twisted.internet import reactor, ssl, task
+
+from bench.fakes import connect, makeServer
+from phxd.server.config import conf
+from phxd.types import HLFile, HLResumeData
+
+from types import SimpleNamespace
+import argparse
+import datetime
+import os
+import socket
+import ssl as pyssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# Settings for each mode; everything else that changes how downloads read is turned off.
+PLAIN = {'ENABLE_SENDFILE': False, 'XFER_READAHEAD': 0, 'ENABLE_MMAP': False, 'FILE_CACHE_SIZE': 0}
+MODES = {
+    'chunked': dict(PLAIN),
+    'sendfile': dict(PLAIN, ENABLE_SENDFILE=True),
+    'readahead': dict(PLAIN, XFER_READAHEAD=2),
+    'mmap': dict(PLAIN, ENABLE_MMAP=True),
+}
+
+
+def makeFile(size, cold):
+    (fd, path) = tempfile.mkstemp(prefix='phxd-bench-')
+    block = os.urandom(1 << 20)
+    with os.fdopen(fd, 'wb') as f:
+        for k in range(size):
+            f.write(block)
+        if cold:
+            f.flush()
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return path
+
+
+def makeCertificate(directory):
+    """ Writes a self-signed key and certificate for localhost, returning their paths. """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+    keyPath = os.path.join(directory, 'key.pem')
+    certPath = os.path.join(directory, 'cert.pem')
+    with open(keyPath, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
+    with open(certPath, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return (keyPath, certPath)
+
+
+def memory():
+    """ Returns the anonymous and file-backed resident memory of this process, in bytes. """
+    sizes = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('RssAnon:', 'RssFile:')):
+                (name, value, unit) = line.split()
+                sizes[name] = int(value) * 1024
+    return (sizes.get('RssAnon:', 0), sizes.get('RssFile:', 0))
+
+
+def download(port, xfid, size, results, tls):
+    sock = socket.create_connection(('127.0.0.1', port))
+    if tls:
+        context = pyssl.SSLContext(pyssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = pyssl.CERT_NONE
+        sock = context.wrap_socket(sock)
+    sock.sendall(struct.pack('!4L', 0x48545846, xfid, 0, 0))
+    buf = bytearray(1 << 20)
+    received = 0
+    while received < size:
+        count = sock.recv_into(buf)
+        if count == 0:
+            break
+        received += count
+    sock.close()
+    results.append(received)
+
+
+def run(mode, size, clients, cold, readDelay, tls):
+    conf.update(SimpleNamespace(**MODES[mode]))
+    if readDelay > 0:
+        plainRead = HLFile.read
+
+        def slowRead(self, fork, size):
+            time.sleep(readDelay / 1000.0)
+            return plainRead(self, fork, size)
+        HLFile.read = slowRead
+    server = makeServer()
+    user = connect(server, 1)[0].context
+    path = makeFile(size, cold)
+    if tls:
+        certDir = tempfile.mkdtemp(prefix='phxd-bench-')
+        context = ssl.DefaultOpenSSLContextFactory(*makeCertificate(certDir))
+        port = reactor.listenSSL(0, server.fileserver, context, interface='127.0.0.1').getHost().port
+    else:
+        port = reactor.listenTCP(0, server.fileserver, interface='127.0.0.1').getHost().port
+    results = []
+    transfers = [server.fileserver.addDownload(user, HLFile(path), HLResumeData(), 0) for k in range(clients)]
+    threads = [threading.Thread(target=download, args=(port, x.id, x.total, results, tls)) for x in transfers]
+
+    def finished():
+        for thread in threads:
+            thread.join()
+        reactor.callFromThread(reactor.stop)
+
+    gaps = []
+    last = [time.time()]
+    peak = [0, 0]
+
+    def sample():
+        (anon, mapped) = memory()
+        peak[0] = max(peak[0], anon)
+        peak[1] = max(peak[1], mapped)
+
+    def tick():
+        now = time.time()
+        gaps.append(now - last[0])
+        last[0] = now
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    threading.Thread(target=finished).start()
+    task.LoopingCall(tick).start(0.001)
+    task.LoopingCall(sample).start(0.05)
+    reactor.run()
+    elapsed = time.time() - start
+    gaps.sort()
+    os.unlink(path)
+    if tls:
+        for name in os.listdir(certDir):
+            os.unlink(os.path.join(certDir, name))
+        os.rmdir(certDir)
+    total = sum(results)
+    ok = total == sum(x.total for x in transfers)
+    print("%-10s %8.1f MB/s %7.2f s   stalls: %6.1f ms max, %5.1f ms 99th pct   RSS: %5.1f MB anon, %6.1f MB file%s" %
+        (mode, total / elapsed / (1 << 20), elapsed, gaps[-1] * 1e3, gaps[int(len(gaps) * 0.99)] * 1e3,
+        peak[0] / (1 << 20), peak[1] / (1 << 20), "" if ok else "  INCOMPLETE"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download throughput for each download mode.")
+    parser.add_argument('--size', type=int, default=512, help="file size in MB (default 512)")
+    parser.add_argument('--clients', type=int, default=1, help="concurrent downloads (default 1)")
+    parser.add_argument('--cold', action='store_true', help="drop the file from the page cache before downloading")
+    parser.add_argument('--read-delay', type=float, default=0, help="milliseconds to sleep before every read")
+    parser.add_argument('--tls', action='store_true', help="download over TLS")
+    parser.add_argument('--mode', choices=sorted(MODES), help="run only this mode")
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.size, args.clients, args.cold, args.read_delay, args.tls)
+        return
+    print("%d MB file, %d client(s)%s%s%s" % (args.size, args.clients, ", cold cache" if args.cold else "",
+        ", %g ms per read" % args.read_delay if args.read_delay else "", ", TLS" if args.tls else ""))
+    for mode in MODES:
+        subprocess.check_call([sys.executable, '-m', 'bench.download', '--mode', mode, '--size', str(args.size),
+            '--clients', str(args.clients), '--read-delay', str(args.read_delay)] + (['--cold'] if args.cold else []) + (['--tls'] if args.tls else []))
+
+
+if __name__ == "__main__":
+    main()
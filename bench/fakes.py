@@ -0,0 +1,68 @@
+""" A HLServer with an in-memory database, and HLProtocol connections to it over transports that discard what is
+written, for benchmarks that exercise the server without sockets. """
+
+from phxd.protocol import HLProtocol
+from phxd.server import HLServer
+from phxd.server.config import conf
+from phxd.types import HLAccount
+
+from types import SimpleNamespace
+
+
+class FakeAddress:
+    host = "127.0.0.1"
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.written = 0
+
+    def getPeer(self):
+        return FakeAddress()
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.written += len(chunk)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def abortConnection(self):
+        pass
+
+
+def makeServer():
+    conf.update(SimpleNamespace(DB_ARG=':memory:', LISTING_CACHE_DIRS=0))
+    return HLServer()
+
+
+def connect(server, count, privs=None):
+    """ Connects and logs in count users with the specified privileges (all of them by default), returning their
+    connections. """
+    conns = []
+    for k in range(count):
+        conn = HLProtocol()
+        conn.factory = server
+        conn.transport = FakeTransport()
+        conn.connectionMade()
+        user = conn.context
+        user.account = HLAccount("user%d" % user.uid)
+        user.account.privs = privs if privs is not None else (1 << 64) - 1
+        user.nick = "user%d" % user.uid
+        if hasattr(server, 'addSession'):
+            server.addSession(user)
+        else:
+            # Trees from before addSession.
+            user.valid = True
+        conns.append(conn)
+    return conns
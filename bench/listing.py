@@ -0,0 +1,65 @@
+""" Times listing a folder of 5,000 files (and some subfolders), each with type and creator sidecar files: building the
+listing every time, as handleFileList used to, with metadata from the sidecars and from the metadata store, and
+getting it from HLListingCache.
+
+    python -m bench.listing [--entries N]
+"""
+
+from phxd.metadata import metadataStore
+from phxd.server.listings import HLListingCache
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+
+def makeFolder(root, entries):
+    path = os.path.join(root, 'folder')
+    os.mkdir(path)
+    for k in range(entries):
+        name = 'file %05d.txt' % k
+        if k % 50 == 0:
+            os.mkdir(os.path.join(path, name))
+            for j in range(10):
+                open(os.path.join(path, name, 'inner %d' % j), 'w').close()
+            continue
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('x' * k)
+        with open(os.path.join(path, '._%s.TYPE' % name), 'w') as f:
+            f.write('TEXT')
+        with open(os.path.join(path, '._%s.CREATOR' % name), 'w') as f:
+            f.write('ttxt')
+    return path
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Folder listing cost, built every time and cached.")
+    parser.add_argument('--entries', type=int, default=5000, help="files and folders in the folder (default 5000)")
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix='phxd-bench-')
+    try:
+        path = makeFolder(root, args.entries)
+        uncached = HLListingCache(0, 0)
+        sidecars = measure(lambda: uncached.get(path), 5)
+        metadataStore.open(os.path.join(root, 'metadata.db'))
+        metadataStore.importSidecars(path)
+        stored = measure(lambda: uncached.get(path), 5)
+        cache = HLListingCache(16, 30.0)
+        cache.get(path)
+        cached = measure(lambda: cache.get(path), 1000)
+        print("listing %d entries:" % args.entries)
+        print("  built, sidecar metadata:    %8.2f ms" % sidecars)
+        print("  built, metadata store:      %8.2f ms" % stored)
+        print("  cached:                     %8.4f ms" % cached)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
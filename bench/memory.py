@@ -0,0 +1,72 @@
+""" Reports the memory held for each connected, logged in user (connection, HLUser and HLAccount) and for each parsed
+packet that is kept around, using tracemalloc.
+
+    python -m bench.memory
+"""
+
+from bench.fakes import connect, makeServer
+from phxd.constants import *
+from phxd.packet import HLPacket
+from phxd.utils import HLEncode
+
+import gc
+import tracemalloc
+
+
+def samplePackets():
+    login = HLPacket(HTLC_HDR_LOGIN, 1)
+    login.addBinary(DATA_LOGIN, HLEncode("guest"))
+    login.addBinary(DATA_PASSWORD, HLEncode(""))
+    login.addString(DATA_NICK, "somebody")
+    login.addNumber(DATA_ICON, 128)
+    chat = HLPacket(HTLC_HDR_CHAT, 2)
+    chat.addString(DATA_STRING, "hello there, how is everyone doing?")
+    download = HLPacket(HTLC_HDR_FILE_GET, 3)
+    download.addString(DATA_FILENAME, "Some File.sit")
+    download.addBinary(DATA_DIR, b"\x00\x01\x00\x00\x07Uploads")
+    return [("login", login.flatten()), ("chat", chat.flatten()), ("file get", download.flatten())]
+
+
+def traced(func):
+    """ Returns what func returns, and the memory allocated while running it that is still held afterwards. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return (result, used)
+
+
+def parse(data, count, read):
+    packets = []
+    for k in range(count):
+        packet = HLPacket()
+        packet.parse(data)
+        if read:
+            # Decode every field, as a handler would.
+            for obj in packet.objs:
+                packet.getString(obj.type)
+                packet.getNumber(obj.type)
+        packets.append(packet)
+    return packets
+
+
+def main():
+    server = makeServer()
+    # Connect a few first, so one-time setup isn't counted.
+    connect(server, 10)
+    users = 2000
+    (conns, used) = traced(lambda: connect(server, users))
+    print("bytes per connected user: %d" % (used // users))
+    count = 2000
+    for (name, data) in samplePackets():
+        (packets, parsed) = traced(lambda: parse(data, count, False))
+        (packets, read) = traced(lambda: parse(data, count, True))
+        print("bytes per %s packet (%d on the wire): %d parsed, %d with every field decoded" %
+            (name, len(data), parsed // count, read // count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" Times finding users and connections by uid with 5,000 users logged in: getUser, sendPacket to a single uid, and
+disconnectUser, against scanning every connection for the matching uid (how they worked before HLServer kept its
+connections and sessions keyed by uid).
+
+    python -m bench.users [--users N]
+"""
+
+from bench.fakes import connect, makeServer
+from phxd.constants import *
+from phxd.packet import HLPacket
+
+import argparse
+import timeit
+
+
+class ScanningServer:
+    """ The lookups as they were when HLServer.connections was a list. """
+
+    def __init__(self, conns):
+        self.connections = list(conns)
+
+    @property
+    def userlist(self):
+        return [c.context for c in self.connections if c.context.valid]
+
+    def getUser(self, uid):
+        for user in self.userlist:
+            if user.uid == uid:
+                return user
+        return None
+
+    def sendPacket(self, packet, to):
+        def f(c):
+            return c.context.uid == to
+        data = packet.flatten()
+        for conn in filter(f, self.connections):
+            conn.transport.write(data)
+
+    def disconnectUser(self, user):
+        for conn in self.connections:
+            if conn.context == user:
+                conn.transport.loseConnection()
+
+
+def measure(func, number=2000):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User and connection lookups by uid, against scanning.")
+    parser.add_argument('--users', type=int, default=5000, help="logged in users (default 5000)")
+    args = parser.parse_args()
+    server = makeServer()
+    conns = connect(server, args.users)
+    scanning = ScanningServer(conns)
+    # The user halfway down the list, so a scan finds it after looking at half of the connections.
+    user = conns[len(conns) // 2].context
+    packet = HLPacket(HTLS_HDR_MSG)
+    packet.addNumber(DATA_UID, 1)
+    packet.addString(DATA_STRING, "a private message")
+    rows = [
+        ("getUser", lambda: server.getUser(user.uid), lambda: scanning.getUser(user.uid)),
+        ("sendPacket to a uid", lambda: server.sendPacket(packet, to=user.uid, immediate=True),
+            lambda: scanning.sendPacket(packet, user.uid)),
+        ("disconnectUser", lambda: server.disconnectUser(user), lambda: scanning.disconnectUser(user)),
+    ]
+    print("%d users" % args.users)
+    print("%-22s %14s %14s" % ("", "by uid (us)", "scan (us)"))
+    for (name, indexed, scan) in rows:
+        print("%-22s %14.2f %14.2f" % (name, measure(indexed), measure(scan, 200)))
+
+
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,7 @@ HTLS_HDR_CHAT_USER_LEAVE = 0x00000076
 HTLS_HDR_CHAT_SUBJECT = 0x00000077
 HTLS_HDR_USER_CHANGE = 0x0000012D
 HTLS_HDR_USER_LEAVE = 0x0000012E
+HTLS_HDR_XFER_QUEUE = 0x000000D3
 HTLS_HDR_SELFINFO = 0x00000162
 HTLS_HDR_BROADCAST = 0x00000163
 HTLS_HDR_TASK = 0x00010000
@@ -87,6 +88,7 @@ DATA_STATUS = 0x0070
 DATA_BAN = 0x0071
 DATA_CHATID = 0x0072
 DATA_SUBJECT = 0x0073
+DATA_WAITINGCOUNT = 0x0074
 DATA_VERSION = 0x00A0
 DATA_SERVERNAME = 0x00A2
 DATA_FILE = 0x00C8
@@ -0,0 +1,127 @@
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+
+
+SQL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        dir text NOT NULL,
+        name text NOT NULL,
+        type varchar(4),
+        creator varchar(4),
+        comment text,
+        PRIMARY KEY (dir, name)
+    ) WITHOUT ROWID;
+"""
+
+SIDECARS = (('type', '.TYPE'), ('creator', '.CREATOR'), ('comment', '.COMMENT'))
+
+HLMetadata = namedtuple('HLMetadata', ('type', 'creator', 'comment'))
+NO_METADATA = HLMetadata(None, None, None)
+
+
+class HLMetadataStore:
+    """ Keeps the type, creator, and comment of files in a single SQLite table with one row per file, keyed by
+    directory and name, in place of the ._name.TYPE, ._name.CREATOR, and ._name.COMMENT sidecar files. Until open
+    is called, isOpen returns False and HLFile uses the sidecar files. Safe to use from any thread. """
+
+    def __init__(self):
+        self.db = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute(SQL_SCHEMA)
+        db.commit()
+        with self.lock:
+            self.db = db
+
+    def isOpen(self):
+        return self.db is not None
+
+    def _key(self, path):
+        return os.path.split(os.path.abspath(path))
+
+    def _subtree(self, path):
+        # Directory values at or below path: path itself, and anything in the [path/, path0) range ('0' follows '/').
+        return ("dir = ? or (dir >= ? and dir < ?)", (path, path + '/', path + '0'))
+
+    def get(self, path):
+        """ Returns the HLMetadata for the file at path, or None if nothing is stored for it. """
+        with self.lock:
+            row = self.db.execute('select type,creator,comment from files where dir=? and name=?', self._key(path)).fetchone()
+        return HLMetadata(*row) if row else None
+
+    def listDir(self, path):
+        """ Returns a dict mapping names to HLMetadata for every file in the directory at path with anything stored. """
+        with self.lock:
+            rows = self.db.execute('select name,type,creator,comment from files where dir=?', (os.path.abspath(path),)).fetchall()
+        return {row[0]: HLMetadata(*row[1:]) for row in rows}
+
+    def _upsert(self, field):
+        assert field in HLMetadata._fields
+        return 'insert into files (dir,name,%s) values (?,?,?) on conflict (dir,name) do update set %s=excluded.%s' % \
+            (field, field, field)
+
+    def set(self, path, field, value):
+        """ Sets one field (type, creator, or comment) for the file at path. """
+        with self.lock:
+            with self.db:
+                self.db.execute(self._upsert(field), self._key(path) + (value,))
+
+    def rename(self, oldPath, newPath):
+        """ Moves everything stored for oldPath, and if it is a folder, for everything under it, in one transaction. """
+        (oldDir, oldName) = self._key(oldPath)
+        (newDir, newName) = self._key(newPath)
+        if (oldDir, oldName) == (newDir, newName):
+            return
+        old = os.path.join(oldDir, oldName)
+        new = os.path.join(newDir, newName)
+        (where, params) = self._subtree(old)
+        with self.lock:
+            with self.db:
+                self.db.execute('delete from files where dir=? and name=?', (newDir, newName))
+                self.db.execute('update files set dir=?, name=? where dir=? and name=?', (newDir, newName, oldDir, oldName))
+                self.db.execute('update files set dir=? || substr(dir, ?) where ' + where, (new, len(old) + 1) + params)
+
+    def delete(self, path):
+        """ Forgets the file at path, and if it is a folder, everything under it. Does nothing until opened. """
+        if self.db is None:
+            return
+        (where, params) = self._subtree(os.path.abspath(path))
+        with self.lock:
+            with self.db:
+                self.db.execute('delete from files where dir=? and name=?', self._key(path))
+                self.db.execute('delete from files where ' + where, params)
+
+    def importSidecars(self, root, remove=False):
+        """ Stores the contents of every ._name.TYPE, ._name.CREATOR, and ._name.COMMENT file under root in one
+        transaction, then optionally removes them. Returns the number of sidecar files imported. """
+        rows = {field: [] for (field, suffix) in SIDECARS}
+        sidecars = []
+        for (dirpath, dirs, files) in os.walk(root):
+            names = set(files) | set(dirs)
+            for fname in files:
+                if (not fname.startswith('._')) or (fname[2:] in names):
+                    # Not a sidecar, or the resource fork of a file that happens to end in .TYPE (etc).
+                    continue
+                for (field, suffix) in SIDECARS:
+                    if fname.endswith(suffix):
+                        sidecar = os.path.join(dirpath, fname)
+                        with open(sidecar, 'r') as f:
+                            value = f.read()
+                        rows[field].append(self._key(os.path.join(dirpath, fname[2:-len(suffix)])) + (value,))
+                        sidecars.append(sidecar)
+                        break
+        with self.lock:
+            with self.db:
+                for (field, values) in rows.items():
+                    self.db.executemany(self._upsert(field), values)
+        if remove:
+            for sidecar in sidecars:
+                os.unlink(sidecar)
+        return len(sidecars)
+
+
+metadataStore = HLMetadataStore()
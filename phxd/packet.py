@@ -4,27 +4,94 @@ from phxd.utils import decodeString
 from struct import *
 
 
+# Precompiled codecs for the fixed-size parts of the wire format.
+_UINT16 = Struct("!H")
+_UINT32 = Struct("!L")
+_UINT64 = Struct("!Q")
+_OBJECT_HEADER = Struct("!2H")
+_PACKET_HEADER = Struct("!5L")
+
+
 class HLObject:
+
+    __slots__ = ('type', '_data', '_string', '_number')
+
     def __init__(self, type, data):
         self.type = type
-        self.data = data
+        self._data = data
+        self._string = None
+        self._number = None
 
     def __str__(self):
-        return "HLObject [type=%x,size=%d]" % (self.type, len(self.data))
+        return "HLObject [type=%x,size=%d]" % (self.type, self.size)
+
+    def _getData(self):
+        # Parsed objects hold a memoryview into the packet body, only copied out when asked for.
+        if isinstance(self._data, memoryview):
+            self._data = self._data.tobytes()
+        return self._data
+
+    def _setData(self, data):
+        self._data = data
+        self._string = None
+        self._number = None
+    data = property(_getData, _setData)
+
+    def _getSize(self):
+        return len(self._data)
+    size = property(_getSize)
+
+    def getString(self):
+        """ Returns the data decoded as a string, decoding it only on first access. """
+        if self._string is None:
+            self._string = decodeString(self.data)
+        return self._string
+
+    def getNumber(self):
+        """ Returns the data decoded as a byte-swapped number, or None if it is not 2, 4, or 8 bytes long.
+        The number is decoded only on first access. """
+        if self._number is None:
+            size = len(self._data)
+            if size == 2:
+                self._number = _UINT16.unpack_from(self._data)[0]
+            elif size == 4:
+                self._number = _UINT32.unpack_from(self._data)[0]
+            elif size == 8:
+                self._number = _UINT64.unpack_from(self._data)[0]
+        return self._number
+
+    def flattenedSize(self):
+        return _OBJECT_HEADER.size + len(self._data)
+
+    def flattenInto(self, buf, offset):
+        """ Writes this object into buf at offset, returning the offset just past it. """
+        size = len(self._data)
+        _OBJECT_HEADER.pack_into(buf, offset, self.type, size)
+        offset += _OBJECT_HEADER.size
+        buf[offset:offset + size] = self._data
+        return offset + size
 
     def flatten(self):
         """ Returns a flattened, byte-swapped string for this hotline object. """
-        return pack("!2H", self.type, len(self.data)) + self.data
+        return _OBJECT_HEADER.pack(self.type, len(self._data)) + self.data
 
 
 class HLContainer:
 
+    __slots__ = ('objs', 'index')
+
     def __init__(self):
         self.objs = []
+        # Maps object type to the list of objects of that type, in wire order.
+        self.index = {}
 
     def addObject(self, obj):
         """ Adds a HLObject to the object list. """
         self.objs.append(obj)
+        if obj.type in self.index:
+            self.index[obj.type].append(obj)
+        else:
+            self.index[obj.type] = [obj]
 
     def addString(self, type, data):
         """ Wraps a string in a HLObject and adds it. """
@@ -37,32 +104,32 @@ class HLContainer:
         """ Wraps a number in a HLObject, byte-swapping it based
         on its magnitude, and adds it. """
         num = int(data)
-        packed = ""
+        packed = b""
         if num < (1 << 16):
-            packed = pack("!H", num)
+            packed = _UINT16.pack(num)
         elif num < (1 << 32):
-            packed = pack("!L", num)
+            packed = _UINT32.pack(num)
         elif num < (1 << 64):
-            packed = pack("!Q", num)
+            packed = _UINT64.pack(num)
         obj = HLObject(type, packed)
         self.addObject(obj)
 
     def addInt16(self, type, data):
         """ Adds a 16-bit byte-swapped number as a HLObject. """
         num = int(data)
-        obj = HLObject(type, pack("!H", num))
+        obj = HLObject(type, _UINT16.pack(num))
         self.addObject(obj)
 
     def addInt32(self, type, data):
         """ Adds a 32-bit byte-swapped number as a HLObject. """
         num = int(data)
-        obj = HLObject(type, pack("!L", num))
+        obj = HLObject(type, _UINT32.pack(num))
         self.addObject(obj)
 
     def addInt64(self, type, data):
         """ Adds a 64-bit byte-swapped number as a HLObject. """
         num = int(data)
-        obj = HLObject(type, pack("!Q", num))
+        obj = HLObject(type, _UINT64.pack(num))
         self.addObject(obj)
 
     def addBinary(self, type, data):
@@ -74,88 +141,102 @@ class HLContainer:
         self.addObject(obj)
 
     def getObject(self, type):
-        for obj in self.objs:
-            if obj.type == type:
-                return obj
+        objs = self.index.get(type)
+        if objs:
+            return objs[0]
         return None
 
     def removeObject(self, type):
-        obj = self.getObject(type)
-        if obj is not None:
+        objs = self.index.get(type)
+        if objs:
+            obj = objs.pop(0)
+            if not objs:
+                del self.index[type]
             self.objs.remove(obj)
 
     def getString(self, type, default=None):
         """ Returns a string for the specified object type, or
         a default value when the specified type is not present. """
-        for obj in self.objs:
-            if (obj.type == type) and (len(obj.data) > 0):
-                return decodeString(obj.data)
+        for obj in self.index.get(type, ()):
+            if obj.size > 0:
+                return obj.getString()
         return default
 
     def getNumber(self, type, default=None):
         """ Returns a byte-swapped number for the specified object type, or
         a default value when the specified type is not present. """
-        for obj in self.objs:
-            if obj.type == type:
-                if len(obj.data) == 2:
-                    return unpack("!H", obj.data)[0]
-                elif len(obj.data) == 4:
-                    return unpack("!L", obj.data)[0]
-                elif len(obj.data) == 8:
-                    return unpack("!Q", obj.data)[0]
+        for obj in self.index.get(type, ()):
+            num = obj.getNumber()
+            if num is not None:
+                return num
         return default
 
     def getBinary(self, type, default=None):
-        for obj in self.objs:
-            if (obj.type == type) and (len(obj.data) > 0):
+        for obj in self.index.get(type, ()):
+            if obj.size > 0:
                 return obj.data
         return default
 
     def getContainer(self, type):
-        for obj in self.objs:
-            if obj.type == type:
-                cont = HLContainer()
-                cont.parse(obj.data)
-                return cont
+        obj = self.getObject(type)
+        if obj is not None:
+            cont = HLContainer()
+            cont.parse(obj.data)
+            return cont
         return None
 
     def getContainers(self, type):
         ret = []
-        for obj in self.objs:
-            if obj.type == type:
-                cont = HLContainer()
-                cont.parse(obj.data)
-                ret.append(cont)
+        for obj in self.index.get(type, ()):
+            cont = HLContainer()
+            cont.parse(obj.data)
+            ret.append(cont)
         return ret
 
     def getObjects(self, type):
-        objs = []
-        for obj in self.objs:
-            if obj.type == type:
-                objs.append(obj)
-        return objs
+        return list(self.index.get(type, ()))
 
     def parse(self, data):
+        """ Parses the objects in data, which may be any buffer. Object data is kept as a view into it. """
         if len(data) < 2:
             return
-        count = unpack("!H", data[0:2])[0]
+        view = memoryview(data)
+        count = _UINT16.unpack_from(view, 0)[0]
         pos = 2
         while count > 0:
-            (obj_type, obj_size) = unpack("!2H", data[pos:pos + 4])
-            pos += 4
-            obj = HLObject(obj_type, data[pos:pos + obj_size])
+            (obj_type, obj_size) = _OBJECT_HEADER.unpack_from(view, pos)
+            pos += _OBJECT_HEADER.size
+            obj = HLObject(obj_type, view[pos:pos + obj_size])
             self.addObject(obj)
             pos += obj_size
             count -= 1
 
-    def flatten(self):
-        data = b""
+    def flattenedSize(self):
+        size = _UINT16.size
         for obj in self.objs:
-            data += obj.flatten()
-        return pack("!H", len(self.objs)) + data
+            size += obj.flattenedSize()
+        return size
+
+    def flattenInto(self, buf, offset):
+        """ Writes the object count and every object into buf at offset, returning the offset just past them. """
+        _UINT16.pack_into(buf, offset, len(self.objs))
+        offset += _UINT16.size
+        for obj in self.objs:
+            offset = obj.flattenInto(buf, offset)
+        return offset
+
+    def flatten(self):
+        buf = bytearray(self.flattenedSize())
+        self.flattenInto(buf, 0)
+        return bytes(buf)
 
 
 class HLPacket (HLContainer):
+
+    __slots__ = ('type', 'seq', 'flags')
+
+    HEADER_SIZE = _PACKET_HEADER.size
+
     def __init__(self, type=0, seq=0, flags=0):
         HLContainer.__init__(self)
         self.type = type
@@ -168,17 +249,28 @@ class HLPacket (HLContainer):
             s += "\n  " + str(obj)
         return s
 
-    def parse(self, data):
-        """ Tries to parse an entire packet from the data passed in. If successful,
+    def parse(self, data, offset=0):
+        """ Tries to parse an entire packet from the data passed in, starting at offset. If successful,
         returns the number of bytes parsed, otherwise returns 0. """
-        if len(data) < 20:
+        if (len(data) - offset) < self.HEADER_SIZE:
             return 0
-        (self.type, self.seq, self.flags, size, check) = unpack("!5L", data[0:20])
-        if (len(data) - 20) < size:
+        size = self.parseHeader(data, offset)
+        if (len(data) - offset - self.HEADER_SIZE) < size:
             return 0
+        self.parseBody(data, offset + self.HEADER_SIZE, size)
+        return self.HEADER_SIZE + size
+
+    def parseHeader(self, data, offset=0):
+        """ Parses the packet header at offset, which must hold at least HEADER_SIZE bytes.
+        Returns the size of the packet body that follows it. """
+        (self.type, self.seq, self.flags, size, check) = _PACKET_HEADER.unpack_from(data, offset)
+        return size
+
+    def parseBody(self, data, offset, size):
+        """ Parses a packet body of the given size at offset, which must hold at least size bytes. """
         if size >= 2:
-            HLContainer.parse(self, data[20:20 + size])
-        return 20 + size
+            # Copy the body out once, so the caller is free to reuse or resize its buffer.
+            HLContainer.parse(self, data[offset:offset + size])
 
     def response(self):
         return HLPacket(HTLS_HDR_TASK, self.seq)
@@ -189,5 +281,8 @@ class HLPacket (HLContainer):
         return p
 
     def flatten(self):
-        data = HLContainer.flatten(self)
-        return pack("!5L", self.type, self.seq, self.flags, len(data), len(data)) + data
+        size = HLContainer.flattenedSize(self)
+        buf = bytearray(self.HEADER_SIZE + size)
+        _PACKET_HEADER.pack_into(buf, 0, self.type, self.seq, self.flags, size, size)
+        HLContainer.flattenInto(self, buf, self.HEADER_SIZE)
+        return bytes(buf)
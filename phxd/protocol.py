@@ -1,58 +1,125 @@
-from twisted.internet import reactor
-from twisted.internet.interfaces import IProducer
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IProducer, IPushProducer, ISSLTransport
 from twisted.internet.protocol import Protocol
 from zope.interface import implementer
 
 from phxd.packet import HLPacket
+from phxd.transfer import HLFileWriter
 
 from struct import unpack
+import logging
+import os
 
 
+@implementer(IPushProducer)
 class HLProtocol(Protocol):
-    """ Protocol subclass to handle parsing and dispatching of raw hotline data. """
+    """ Protocol subclass to handle parsing and dispatching of raw hotline data. Registers itself as a push
+    producer on its transport, so outbound data is held in its own queue while the peer is not keeping up. """
 
     context = None
     timer = None
 
-    def __init__(self):
-        self.packet = HLPacket()
-        self.gotMagic = False
-        self.expectedMagicLen = 0
-        self.buffered = b""
+    # Limits on the declared size of a single packet body, and on the amount of unparsed data
+    # buffered for the connection. Zero means no limit; the server sets these from its config.
+    maxPacketSize = 0
+    maxBufferSize = 0
+
+    # Limits on outbound data queued while the transport is paused. Past the soft limit, collapsible
+    # packets replace their queued predecessors; past the hard limit, the connection is dropped.
+    softQueueLimit = 0
+    hardQueueLimit = 0
+
+    # Parsing state. The packet whose header has been parsed, and the size of its body, are only set while waiting
+    # for the rest of it; buffered is replaced with a bytearray while there is unparsed data.
+    packet = None
+    bodySize = None
+    gotMagic = False
+    expectedMagicLen = 0
+    buffered = b""
+    offset = 0
+    dropped = False
+
+    # Outbound data queued for the next flush (a list, while there is any), and the pending flush call.
+    outgoing = None
+    flushCall = None
+    queuedBytes = 0
+    # Maps collapse keys to the index in outgoing of the last packet queued with that key, while there are any.
+    collapsible = None
+    collapsedCount = 0
+    overflowed = False
+    paused = False
 
     def connectionMade(self):
         """ Called when a connection is accepted. """
+        self.transport.registerProducer(self, True)
         self.factory.notifyConnect(self)
 
     def connectionLost(self, reason):
         """ Called when the connection is lost. """
+        self.discardOutgoing()
         self.factory.notifyDisconnect(self)
 
     def dataReceived(self, data):
         """ Called when the socket receives data. """
-        self.buffered += data
+        if self.dropped:
+            return
+        if self.buffered:
+            self.buffered += data
+        else:
+            self.buffered = bytearray(data)
         self.parseBuffer()
+        if self.maxBufferSize and (len(self.buffered) - self.offset) > self.maxBufferSize:
+            self.dropConnection("buffer limit exceeded")
 
     def parseBuffer(self):
         """ Parses the current buffer until the buffer is empty or until no more packets can be parsed. """
         if self.gotMagic:
-            done = False
-            while not done:
-                size = self.packet.parse(self.buffered)
-                if size > 0:
-                    self.buffered = self.buffered[size:]
-                    self.factory.notifyPacket(self, self.packet)
+            while not self.dropped:
+                if self.bodySize is None:
+                    if (len(self.buffered) - self.offset) < HLPacket.HEADER_SIZE:
+                        break
                     self.packet = HLPacket()
-                else:
-                    done = True
+                    self.bodySize = self.packet.parseHeader(self.buffered, self.offset)
+                    self.offset += HLPacket.HEADER_SIZE
+                    if self.maxPacketSize and self.bodySize > self.maxPacketSize:
+                        self.dropConnection("packet size %d exceeds limit" % self.bodySize)
+                        return
+                if (len(self.buffered) - self.offset) < self.bodySize:
+                    break
+                self.packet.parseBody(self.buffered, self.offset, self.bodySize)
+                self.offset += self.bodySize
+                packet = self.packet
+                self.packet = None
+                self.bodySize = None
+                self.factory.notifyPacket(self, packet)
         else:
-            if len(self.buffered) >= self.expectedMagicLen:
-                magic = self.buffered[0:self.expectedMagicLen]
-                self.buffered = self.buffered[self.expectedMagicLen:]
+            if (len(self.buffered) - self.offset) >= self.expectedMagicLen:
+                magic = bytes(self.buffered[self.offset:self.offset + self.expectedMagicLen])
+                self.offset += self.expectedMagicLen
                 self.gotMagic = True
                 self.factory.notifyMagic(self, magic)
-                if len(self.buffered) > 0:
+                if len(self.buffered) > self.offset:
                     self.parseBuffer()
+        self.compactBuffer()
+
+    def dropConnection(self, reason):
+        """ Throws away anything buffered and aborts the connection without flushing pending writes. """
+        logging.debug("dropping connection from %s: %s", self.transport.getPeer().host, reason)
+        self.dropped = True
+        self.buffered = b""
+        self.offset = 0
+        self.discardOutgoing()
+        self.transport.abortConnection()
+
+    def compactBuffer(self):
+        """ Drops consumed bytes from the front of the buffer once they make up at least half of it,
+        so each byte is moved at most a constant number of times. An idle connection keeps no buffer at all. """
+        if self.offset > 0 and (self.offset * 2) >= len(self.buffered):
+            if self.offset == len(self.buffered):
+                self.buffered = b""
+            else:
+                del self.buffered[:self.offset]
+            self.offset = 0
 
     def waitForMagic(self, magicLen):
         self.expectedMagicLen = magicLen
@@ -60,9 +127,86 @@ class HLProtocol(Protocol):
     def writeMagic(self, magic):
         self.transport.write(magic)
 
-    def writePacket(self, packet):
+    def writePacket(self, packet, immediate=False):
         """ Flattens and writes a packet out to the socket. """
-        self.transport.write(packet.flatten())
+        self.writeData(packet.flatten(), immediate)
+
+    def writeData(self, data, immediate=False, collapseKey=None):
+        """ Queues already-flattened packet data to be written out to the socket along with anything else
+        written during this pass through the reactor. If immediate is True, the queue is flushed right away.
+        Data with a collapseKey may replace queued data with the same key once the queue is past its soft limit. """
+        if self.dropped:
+            return
+        if (collapseKey is not None) and self.softQueueLimit and (self.queuedBytes > self.softQueueLimit) and \
+                (self.collapsible is not None) and (collapseKey in self.collapsible):
+            idx = self.collapsible[collapseKey]
+            self.queuedBytes += len(data) - len(self.outgoing[idx])
+            self.outgoing[idx] = data
+            self.collapsedCount += 1
+        else:
+            if self.outgoing is None:
+                self.outgoing = []
+            if collapseKey is not None:
+                if self.collapsible is None:
+                    self.collapsible = {}
+                self.collapsible[collapseKey] = len(self.outgoing)
+            self.outgoing.append(data)
+            self.queuedBytes += len(data)
+            if self.hardQueueLimit and (self.queuedBytes > self.hardQueueLimit):
+                self.overflowed = True
+                self.dropConnection("outbound queue limit exceeded")
+                return
+        if immediate:
+            self.flushOutgoing()
+        elif self.flushCall is None:
+            self.flushCall = reactor.callLater(0, self.flushOutgoing)
+
+    def flushOutgoing(self):
+        """ Writes all queued data out to the socket in a single call, unless the transport has paused us. """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if not self.paused:
+            self._writeOutgoing()
+
+    def _writeOutgoing(self):
+        if self.outgoing:
+            data = self.outgoing
+            self.outgoing = None
+            self.queuedBytes = 0
+            self.collapsible = None
+            self.transport.writeSequence(data)
+
+    def loseConnection(self):
+        """ Writes anything still queued, then closes the connection once it has been written. """
+        self.discardOutgoing(write=True)
+        # A transport with a registered producer asks it for more instead of closing once its buffer drains.
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def discardOutgoing(self, write=False):
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if write:
+            self._writeOutgoing()
+        self.outgoing = None
+        self.queuedBytes = 0
+        self.collapsible = None
+
+    # IPushProducer methods, called by the transport as its write buffer fills and drains.
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flushOutgoing()
+
+    def stopProducing(self):
+        self.paused = True
 
 
 @implementer(IProducer)
@@ -71,19 +215,39 @@ class HLTransferProtocol(Protocol):
     info = None
     gotMagic = False
     buffered = b""
+    # Set by the factory to allow downloads to send fork data with os.sendfile where the transport permits.
+    useSendfile = False
+    # Set by the factory to the number of chunks read ahead from a thread pool for downloads that can't use sendfile.
+    readAhead = 0
+    # Set by the factory to send download fork data from memory-mapped files where sendfile can't be used.
+    useMmap = False
+    # Set by the factory to a bandwidth shaper, which decides when a download with buckets may send.
+    shaper = None
+    buckets = ()
 
     def connectionMade(self):
         self.factory.notifyConnect(self)
 
     def connectionLost(self, reason):
         if self.info:
-            self.info.finish()
-        self.factory.notifyDisconnect(self)
+            # Uploads may still be writing out queued data, so wait for that before reporting the disconnect.
+            defer.maybeDeferred(self.info.finish).addBoth(lambda _: self.factory.notifyDisconnect(self))
+        else:
+            self.factory.notifyDisconnect(self)
 
     def start(self, transferInfo, sendMagic=False):
         """ This should be called after magic has been received. transferInfo should be a HLTransfer instance. """
         self.info = transferInfo
-        if not self.info.isIncoming():
+        if self.info.isIncoming():
+            self.info.writer = HLFileWriter(self.info.file, self.transport)
+        else:
+            if self.canSendfile():
+                self.info.enableSendfile()
+            else:
+                if self.useMmap:
+                    self.info.enableMmap()
+                if self.readAhead > 0:
+                    self.info.enableReadAhead(self.readAhead)
             self.transport.registerProducer(self, False)
         self.info.start()
         reactor.callLater(0, self.parseBuffer)
@@ -114,13 +278,78 @@ class HLTransferProtocol(Protocol):
         self.buffered += data
         self.parseBuffer()
 
+    def canSendfile(self):
+        """ Returns True if fork data can go straight from the file to this transport's socket. """
+        return self.useSendfile and hasattr(os, 'sendfile') and hasattr(self.transport, 'getHandle') and \
+            not ISSLTransport.providedBy(self.transport)
+
     def resumeProducing(self):
         """ The transport asked us for more data. Should only happen for downloads after we've been registered as a producer. """
+        if self.shaper is not None and self.buckets:
+            self.shaper.schedule(self)
+        else:
+            self.produce()
+
+    def produce(self, limit=None):
+        """ Sends the next piece of the download, returning the number of bytes sent. If limit is given,
+        fork data sent with sendfile is capped to it; chunks going through the transport are sent whole. """
+        if self.info.segments is not None:
+            return self.sendSegment(limit)
         chunk = self.info.getDataChunk()
+        if chunk is None:
+            # Still being read; ask again once it has been.
+            self.info.reader.notify(self.resumeProducing)
+            return 0
         if len(chunk) > 0:
+            if isinstance(chunk, memoryview) and not ISSLTransport.providedBy(self.transport):
+                # TLS takes views of mapped files without copying, but plain TCP transports insist on bytes.
+                chunk = chunk.tobytes()
             self.transport.write(chunk)
         else:
             self.transport.unregisterProducer()
+            if not self.info.isComplete():
+                # The file was shortened, or couldn't be read; the client can never get the rest.
+                self.transport.loseConnection()
+        return len(chunk)
+
+    def sendSegment(self, limit=None):
+        """ Sends the next download segment. Headers go through the transport; fork data is sent with sendfile,
+        bypassing the transport's buffer, which is always empty when a pull producer is asked for more. """
+        segment = self.info.nextSegment()
+        if segment is None:
+            self.transport.unregisterProducer()
+            if not self.info.isComplete():
+                # The file was shortened before we got to it; the client can never get the rest.
+                self.transport.loseConnection()
+            return 0
+        if isinstance(segment, bytes):
+            self.transport.write(segment)
+            self.info.segmentSent(len(segment))
+            return len(segment)
+        (fileno, offset, count) = segment
+        if limit is not None:
+            count = min(count, limit)
+        sent = 0
+        try:
+            sent = os.sendfile(self.transport.getHandle().fileno(), fileno, offset, count)
+            if (sent == 0) and (count > 0):
+                # The file is shorter than it was when the transfer size was sent; we can't finish.
+                self.abortDownload()
+                return 0
+            self.info.segmentSent(sent)
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.abortDownload()
+            return 0
+        # Nothing went through the transport, so have it call us again once the socket is writable.
+        self.transport.startWriting()
+        return sent
+
+    def abortDownload(self):
+        """ Closes a download that can't be finished. The transport won't close while we're still its producer. """
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
 
     def pauseProducing(self):
         pass
@@ -4,17 +4,23 @@ from twisted.internet.protocol import Factory
 
 from phxd import tracker
 from phxd.constants import *
+from phxd.metadata import metadataStore
 from phxd.packet import HLPacket
+from phxd.permissions import PRIV_READ_CHAT, PRIV_READ_NEWS
 from phxd.protocol import HLProtocol
 from phxd.server import database
 from phxd.server.config import conf
-from phxd.server.files import HLFileServer
+from phxd.server.dispatch import dispatchTable
+from phxd.server.files import HLFileJobs, HLFileServer
+from phxd.server.listings import HLListingCache
+from phxd.server.search import HLFileSearch
 from phxd.server.signals import *
 from phxd.types import *
 from phxd.utils import HLCharConst, HLServerMagic
 
 from struct import unpack
 import hashlib
+import heapq
 import logging
 import time
 
@@ -24,22 +30,46 @@ class HLServer(Factory):
 
     protocol = HLProtocol
 
+    # Named groups of logged in users that packets can be broadcast to, and the privilege needed to be in each.
+    broadcastGroups = {
+        'users': None,
+        'chat': PRIV_READ_CHAT,
+        'news': PRIV_READ_NEWS,
+    }
+
     def __init__(self):
         self.lastUID = 0
         self.lastChatID = 0
-        self.connections = []
+        # Maps uids to connections, and the uids of logged in users to their HLUser, both in the order they arrived.
+        self.connections = {}
+        self.sessions = {}
+        # Maps broadcast group names to {uid: connection} for their members.
+        self.groups = dict((name, {}) for name in self.broadcastGroups)
+        # (deadline, uid) pairs for logged in users who aren't away, and the uids with an entry. Entries are never
+        # updated in place; a user who has been active since is pushed again with a new deadline when theirs comes up.
+        self.idleDeadlines = []
+        self.idleChecks = set()
         self.chats = {}
         self.defaultIcon = ""
         self.tempBans = {}
         self.startTime = None
         self.database = database.instance(conf.DB_TYPE, conf.DB_ARG)
         self.fileserver = HLFileServer(self)
+        chunkCache.setBudget(conf.FILE_CACHE_SIZE)
+        if conf.METADATA_DB:
+            metadataStore.open(conf.METADATA_DB)
+        self.listings = HLListingCache(conf.LISTING_CACHE_DIRS, conf.LISTING_CACHE_AGE)
+        self.fileindex = HLFileSearch()
+        self.filejobs = HLFileJobs()
         self._listeners = []
+        # Outbound queue counters for connections that have closed; see outboundStats.
+        self.collapsedPackets = 0
+        self.slowDisconnects = 0
         self._tickle = task.LoopingCall(self.checkUsers)
         self._pinger = task.LoopingCall(self.pingTracker)
 
     def _getUserlist(self):
-        return [c.context for c in self.connections if c.context.valid]
+        return list(self.sessions.values())
     userlist = property(_getUserlist)
 
     def start(self):
@@ -60,6 +90,7 @@ class HLServer(Factory):
             self._listeners.append(reactor.listenSSL(conf.SSL_PORT, self, sslContext))
             self._listeners.append(reactor.listenSSL(conf.SSL_PORT + 1, self.fileserver, sslContext))
         self.startTime = time.time()
+        self.fileindex.start(conf.FILE_ROOT)
         self._tickle.start(5.0, False)
         if conf.ENABLE_TRACKER_REGISTER:
             self._pinger.start(conf.TRACKER_INTERVAL, True)
@@ -75,10 +106,14 @@ class HLServer(Factory):
 
     def notifyConnect(self, conn):
         conn.waitForMagic(HTLC_MAGIC_LEN)
-        self.connections.append(conn)
+        conn.maxPacketSize = conf.MAX_PACKET_SIZE
+        conn.maxBufferSize = conf.MAX_BUFFER_SIZE
+        conn.softQueueLimit = conf.OUTBOUND_SOFT_LIMIT
+        conn.hardQueueLimit = conf.OUTBOUND_HARD_LIMIT
         addr = conn.transport.getPeer()
         self.lastUID += 1
         conn.context = HLUser(self.lastUID, addr.host)
+        self.connections[conn.context.uid] = conn
         dispatcher.send(signal=client_connected, sender=self, server=self, user=conn.context)
 
     def notifyMagic(self, conn, magic):
@@ -88,10 +123,17 @@ class HLServer(Factory):
             conn.writeMagic(HLServerMagic())
         else:
             logging.debug("incorrect magic from %s", addr.host)
-            conn.transport.loseConnection()
+            conn.loseConnection()
 
     def notifyDisconnect(self, conn):
-        self.connections.remove(conn)
+        del self.connections[conn.context.uid]
+        self.sessions.pop(conn.context.uid, None)
+        for members in self.groups.values():
+            members.pop(conn.context.uid, None)
+        self.collapsedPackets += conn.collapsedCount
+        if conn.overflowed:
+            logging.info("[server] disconnected slow client %s", conn.context)
+            self.slowDisconnects += 1
         dispatcher.send(signal=client_disconnected, sender=self, server=self, user=conn.context)
 
     def notifyPacket(self, conn, packet):
@@ -101,45 +143,52 @@ class HLServer(Factory):
                 if conn.context.valid and ((conn.context.status & STATUS_AWAY) != 0):
                     conn.context.status &= ~STATUS_AWAY
                     self.sendUserChange(conn.context)
-            dispatcher.send(signal=packet_received, sender=self, server=self, user=conn.context, packet=packet)
-            dispatcher.send(signal=(packet_received, packet.type), sender=self, server=self, user=conn.context, packet=packet)
+                    self.watchIdle(conn.context)
+            dispatchTable.dispatch(self, conn.context, packet)
         except HLException as e:
             self.sendPacket(packet.error(e.msg), conn.context)
             if e.fatal:
                 logging.debug("fatal error, disconnecting %s: %s", conn.context, str(e))
-                conn.transport.loseConnection()
+                conn.loseConnection()
         except Exception as e:
             logging.exception("unhandled exception: %s", e)
             self.sendPacket(packet.error(e), conn.context)
 
     # Packet sending methods
 
-    def sendPacket(self, packet, to=None):
-        f = None
-        if isinstance(to, int):
-            def f(c):
-                return c.context.uid == to
+    def sendPacket(self, packet, to=None, immediate=False, collapseKey=None):
+        """ Sends packet to the connections selected by to (a uid, list of uids, HLUser, broadcast group name, or
+        connection filter; None sends to everyone). Writes are normally coalesced per reactor pass; immediate flushes them right away.
+        Packets with a collapseKey may be merged with a queued packet of the same key for slow clients. """
+        if to is None:
+            conns = list(self.connections.values())
+        elif isinstance(to, int):
+            conns = self.connectionsFor((to,))
         elif isinstance(to, (list, tuple)):
-            def f(c):
-                return c.context.uid in to
+            conns = self.connectionsFor(set(to))
         elif isinstance(to, HLUser):
-            def f(c):
-                return c.context == to
-        elif callable(to):
-            f = to
-        conns = list(filter(f, self.connections))
-        users = [c.context for c in conns]
-        try:
-            dispatcher.send(signal=packet_outgoing, sender=self, server=self, packet=packet, users=users)
-            dispatcher.send(signal=(packet_outgoing, packet.type), sender=self, server=self, packet=packet, users=users)
-        except Exception as e:
-            print("error in packet filter:", str(e))
-        except:
-            logging.exception('packet filter error')
+            conns = [c for c in self.connectionsFor((to.uid,)) if c.context == to]
+        elif isinstance(to, str):
+            conns = list(self.groups[to].values())
+        else:
+            conns = list(filter(to, self.connections.values()))
+        self.filterPacket(packet, conns)
+        # Flatten once, after any filters have had their chance to change the packet.
+        data = packet.flatten()
         for conn in conns:
-            conn.writePacket(packet)
+            conn.writeData(data, immediate, collapseKey)
 
-    def sendUserChange(self, user):
+    def filterPacket(self, packet, conns):
+        """ Runs any packet filters for the packet's type before it is sent to conns. """
+        if dispatchTable.hasFilters(packet.type):
+            try:
+                dispatchTable.filter(self, packet, [c.context for c in conns])
+            except Exception as e:
+                print("error in packet filter:", str(e))
+            except:
+                logging.exception('packet filter error')
+
+    def userChangePacket(self, user):
         change = HLPacket(HTLS_HDR_USER_CHANGE)
         change.addNumber(DATA_UID, user.uid)
         change.addString(DATA_NICK, user.nick)
@@ -147,7 +196,35 @@ class HLServer(Factory):
         change.addNumber(DATA_STATUS, user.status)
         if user.color >= 0:
             change.addInt32(DATA_COLOR, user.color)
-        self.sendPacket(change, lambda c: c.context.valid)
+        return change
+
+    def sendUserChange(self, user):
+        self.sendPacket(self.userChangePacket(user), 'users', collapseKey=(HTLS_HDR_USER_CHANGE, user.uid))
+
+    def sendUserChanges(self, users):
+        """ Sends the changes for several users to everyone logged in, flattened together into one write per connection. """
+        if len(users) == 1:
+            self.sendUserChange(users[0])
+            return
+        conns = list(self.groups['users'].values())
+        changes = []
+        for user in users:
+            change = self.userChangePacket(user)
+            self.filterPacket(change, conns)
+            changes.append(change.flatten())
+        data = b"".join(changes)
+        for conn in conns:
+            conn.writeData(data)
+
+    def fileChanged(self, path):
+        """ Called by the file handlers after they create, modify, move, or delete something at path. """
+        self.listings.changed(path)
+        self.fileindex.changed(path)
+
+    def outboundStats(self):
+        """ Returns the number of packets merged and clients disconnected by outbound queue policing. """
+        collapsed = self.collapsedPackets + sum(c.collapsedCount for c in self.connections.values())
+        return {'collapsed': collapsed, 'disconnected': self.slowDisconnects}
 
     # Banlist functions
 
@@ -172,17 +249,41 @@ class HLServer(Factory):
     # User functions
 
     def getUser(self, uid):
-        """ Gets the HLUser object for the specified uid. """
+        """ Gets the HLUser object for the specified uid, if that user has logged in. """
+        return self.sessions.get(uid)
+
+    def addSession(self, user):
+        """ Marks a user as logged in, adding them to the userlist. """
+        user.valid = True
+        self.sessions[user.uid] = user
+        self.updateGroups(user)
+        self.watchIdle(user)
+
+    def updateGroups(self, user):
+        """ Adds a user to or removes them from each broadcast group, according to their current privileges. """
+        conn = self.connections.get(user.uid)
+        for (name, priv) in self.broadcastGroups.items():
+            if (conn is not None) and user.valid and ((priv is None) or user.hasPriv(priv)):
+                self.groups[name][user.uid] = conn
+            else:
+                self.groups[name].pop(user.uid, None)
+
+    def updateAccount(self, acct):
+        """ Applies a modified account's privileges to every logged in user of it. """
         for user in self.userlist:
-            if user.uid == uid:
-                return user
-        return None
+            if user.account.login == acct.login:
+                user.account.privs = acct.privs
+                self.updateGroups(user)
+
+    def connectionsFor(self, uids):
+        """ Returns the connections for whichever of the specified uids are still connected. """
+        return [self.connections[uid] for uid in uids if uid in self.connections]
 
     def disconnectUser(self, user):
         """ Actively disconnect the specified user. """
-        for conn in self.connections:
-            if conn.context == user:
-                conn.transport.loseConnection()
+        conn = self.connections.get(user.uid)
+        if (conn is not None) and (conn.context == user):
+            conn.loseConnection()
 
     # Private chat functions
 
@@ -206,14 +307,31 @@ class HLServer(Factory):
 
     # Repeating tasks
 
+    def watchIdle(self, user):
+        """ Schedules a check for whether the user has gone idle, unless one is already scheduled. """
+        if user.uid not in self.idleChecks:
+            self.idleChecks.add(user.uid)
+            heapq.heappush(self.idleDeadlines, (user.lastPacketTime + conf.IDLE_TIME, user.uid))
+
     def checkUsers(self):
+        """ Marks users away once they have been idle for IDLE_TIME, only looking at users whose deadline has passed.
+        Everyone going idle in the same pass is announced together. """
         now = time.time()
-        for user in self.userlist:
+        idle = []
+        while self.idleDeadlines and (self.idleDeadlines[0][0] < now):
+            (deadline, uid) = heapq.heappop(self.idleDeadlines)
+            self.idleChecks.discard(uid)
+            user = self.sessions.get(uid)
+            if (user is None) or ((user.status & STATUS_AWAY) != 0):
+                # Gone, or already away; coming back from away schedules a new check.
+                continue
             if (now - user.lastPacketTime) > conf.IDLE_TIME:
-                newStatus = user.status | STATUS_AWAY
-                if newStatus != user.status:
-                    user.status = newStatus
-                    self.sendUserChange(user)
+                user.status |= STATUS_AWAY
+                idle.append(user)
+            else:
+                self.watchIdle(user)
+        if idle:
+            self.sendUserChanges(idle)
 
     def pingTracker(self):
         for tracker_conf in conf.TRACKERS:
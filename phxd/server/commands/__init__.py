@@ -1 +1,55 @@
 # chat commands module
+
+import logging
+import sys
+
+
+class HLCommandRegistry:
+    """ Loads chat command modules (each with a handle function) from a package the first time they are used, and
+    keeps them until reload is called. Names that don't load are remembered too, so unknown commands are cheap. """
+
+    # Most unknown names to remember before forgetting them all, since anyone can make them up.
+    MAX_MISSING = 1024
+
+    def __init__(self, package):
+        self.package = package
+        self.handlers = {}
+        self.missing = set()
+
+    def get(self, name):
+        """ Returns the handle function for the named command, or None if there isn't one. """
+        handler = self.handlers.get(name)
+        if (handler is not None) or (name in self.missing):
+            return handler
+        if name.isidentifier():
+            handler = self.load(name)
+        if handler is None:
+            if len(self.missing) >= self.MAX_MISSING:
+                self.missing.clear()
+            self.missing.add(name)
+        else:
+            self.handlers[name] = handler
+        return handler
+
+    def load(self, name):
+        mod_path = "%s.%s" % (self.package, name)
+        try:
+            mod = __import__(mod_path, None, None, [self.package])
+            return getattr(mod, "handle")
+        except ImportError as e:
+            if e.name != mod_path:
+                logging.error("%s: %s", mod_path, e)
+        except Exception as e:
+            logging.error("%s: %s", mod_path, e)
+        return None
+
+    def reload(self):
+        """ Forgets every loaded and unknown command, so each is imported afresh the next time it is used. """
+        for name in list(self.handlers) + list(self.missing):
+            sys.modules.pop("%s.%s" % (self.package, name), None)
+        self.handlers = {}
+        self.missing = set()
+        logging.debug("reloading chat commands")
+
+
+commands = HLCommandRegistry(__name__)
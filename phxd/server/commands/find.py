@@ -2,29 +2,31 @@ from phxd.constants import *
 from phxd.packet import HLPacket
 from phxd.server.config import conf
 
-import os
+import re
 
 
 def handle(server, user, arg, ref):
+    # "/find text" shows the first page of results, "/find -N text" shows page N.
+    match = re.match(r"-(\d+)\s+(.*)", arg)
+    page = 1
+    if match:
+        page = max(1, int(match.group(1)))
+        arg = match.group(2)
     if len(arg) > 0:
         rootDir = user.account.fileRoot
         if not rootDir:
             rootDir = conf.FILE_ROOT
-        pre = len(rootDir)
-        matches = []
-        for (root, dirs, files) in os.walk(rootDir):
-            root = root.decode("utf-8", "replace")
-            for name in dirs:
-                name = name.decode("utf-8", "replace")
-                if arg.upper() in name.upper():
-                    matches.append("+ " + os.path.join(root, name)[pre:])
-            for name in files:
-                name = name.decode("utf-8", "replace")
-                if arg.upper() in name.upper():
-                    matches.append("- " + os.path.join(root, name)[pre:])
-        found = "(none)"
-        if len(matches) > 0:
-            found = "\r > ".join(matches)
+        size = conf.FIND_PAGE_SIZE
+        results = server.fileindex.search(rootDir, arg, (page - 1) * size, size)
+        if results is None:
+            found = "(still indexing files, try again shortly)"
+        else:
+            (matches, more) = results
+            found = "(none)"
+            if len(matches) > 0:
+                found = "\r > ".join(("+ " if isFolder else "- ") + path for (path, isFolder) in matches)
+            if more:
+                found += "\r > (more: /find -%d %s)" % (page + 1, arg)
         matchStr = "\r > --- search results for '%s' ------------\r > %s" % (arg, found)
         chat = HLPacket(HTLS_HDR_CHAT)
         chat.addString(DATA_STRING, matchStr)
@@ -4,6 +4,7 @@ from phxd.constants import *
 from phxd.packet import HLPacket
 from phxd.permissions import PRIV_MODIFY_USERS
 from phxd.server import handlers
+from phxd.server.commands import commands
 
 
 def handle(server, user, arg, ref):
@@ -19,4 +20,7 @@ def handle(server, user, arg, ref):
             server.sendPacket(chat, user)
         elif cmd == "reload":
             # call next time through the event loop to avoid problems
-            reactor.callLater(0, handlers.reload, "phxd.server.handlers", mod)
+            if mod == "commands":
+                reactor.callLater(0, commands.reload)
+            else:
+                reactor.callLater(0, handlers.reload, "phxd.server.handlers", mod)
@@ -1,8 +1,6 @@
-from pydispatch import dispatcher
-
 from phxd.constants import *
 from phxd.packet import HLPacket
-from phxd.server.signals import *
+from phxd.server.dispatch import dispatchTable
 from phxd.types import HLException
 
 
@@ -12,7 +10,7 @@ def handle(server, user, args, ref):
         try:
             kick = HLPacket(HTLC_HDR_KICK)
             kick.addNumber(DATA_UID, int(id))
-            dispatcher.send(signal=(packet_received, kick.type), sender=server, server=server, user=user, packet=kick)
+            dispatchTable.dispatch(server, user, kick)
         except ValueError:
             pass
         except HLException:
@@ -1,8 +1,6 @@
-from pydispatch import dispatcher
-
 from phxd.constants import *
 from phxd.packet import HLPacket
-from phxd.server.signals import *
+from phxd.server.dispatch import dispatchTable
 
 
 def handle(server, user, args, ref):
@@ -11,4 +9,4 @@ def handle(server, user, args, ref):
     chat.addNumber(DATA_OPTION, 1)
     if ref > 0:
         chat.addInt32(DATA_CHATID, ref)
-    dispatcher.send(signal=(packet_received, chat.type), sender=server, server=server, user=user, packet=chat)
+    dispatchTable.dispatch(server, user, chat)
@@ -1,6 +1,8 @@
 from phxd.constants import *
 from phxd.packet import HLPacket
 from phxd.permissions import PRIV_USER_INFO
+from phxd.server.config import conf
+from phxd.types import chunkCache
 
 
 def handle(server, user, args, ref):
@@ -9,11 +11,20 @@ def handle(server, user, args, ref):
         if len(server.fileserver.transfers) == 0:
             str += "\r > No file transfers in progress."
         else:
-            str += "\r > File transfers:"
+            kps = server.fileserver.shaper.totalBPS(server.fileserver.transfers) // 1024
+            str += "\r > File transfers (downloads @ %sk/sec):" % kps
             for xfer in server.fileserver.transfers:
                 u = server.getUser(xfer.owner)
                 owner = u.nick if u else "<none>"
                 str += "\r > (%s) %s" % (owner, xfer)
+        if chunkCache.budget > 0:
+            (hits, misses, evictions, size) = chunkCache.stats()
+            str += "\r > Chunk cache: %s hits, %s misses, %s evictions, %sk of %sk used" % \
+                (hits, misses, evictions, size // 1024, chunkCache.budget // 1024)
+        if conf.OUTBOUND_SOFT_LIMIT or conf.OUTBOUND_HARD_LIMIT:
+            stats = server.outboundStats()
+            str += "\r > Outbound queues: %s packets merged, %s slow clients disconnected" % \
+                (stats['collapsed'], stats['disconnected'])
         chat = HLPacket(HTLS_HDR_CHAT)
         chat.addString(DATA_STRING, str)
         if ref > 0:
@@ -23,6 +23,13 @@ SERVER_PORTS = (5500,)
 SERVER_NAME = "my_phxd_server"
 IDLE_TIME = 10 * 60
 BAN_TIME = 15 * 60
+# clients declaring a larger packet, or with more unparsed data buffered, are disconnected (0 = no limit)
+MAX_PACKET_SIZE = 1024 * 1024
+MAX_BUFFER_SIZE = 2 * 1024 * 1024
+# outbound data queued for a slow client; past the soft limit redundant user changes are merged,
+# past the hard limit the client is disconnected (0 = no limit)
+OUTBOUND_SOFT_LIMIT = 256 * 1024
+OUTBOUND_HARD_LIMIT = 4 * 1024 * 1024
 
 ################################################################################
 # SSL configuration
@@ -80,6 +87,15 @@ DEFAULT_NEWS_LIMIT = 25
 
 FILE_ROOT = "files"
 SHOW_DOTFILES = False
+# SQLite database holding file types, creators, and comments, instead of ._name.TYPE/.CREATOR/.COMMENT files next
+# to each file (None = use those files). Import existing ones first with scripts/phxd-import-metadata.
+METADATA_DB = None
+# number of results /find shows at a time
+FIND_PAGE_SIZE = 50
+# number of directory listings kept in memory (0 = none), and how long a listing may be reused without inotify
+# telling us about changes (it is always rebuilt when the directory's mtime changes)
+LISTING_CACHE_DIRS = 256
+LISTING_CACHE_AGE = 30.0
 DIR_UMASK = 0o755
 UPLOAD_SCRIPT = None
 
@@ -88,6 +104,24 @@ UPLOAD_SCRIPT = None
 ################################################################################
 
 XFER_TIMEOUT = 30.0
+# maximum number of transfers running at once, in total and for a single user (0 = unlimited); others are queued
+MAX_XFERS = 0
+MAX_XFERS_PER_USER = 0
+# send download fork data with os.sendfile where available (never used for SSL connections)
+ENABLE_SENDFILE = True
+# number of chunks read ahead from a thread pool for downloads not using sendfile (0 = read on the reactor thread)
+XFER_READAHEAD = 2
+# bytes of file data kept in memory for downloads not using sendfile, shared by everyone downloading a file (0 = off)
+FILE_CACHE_SIZE = 64 * 1024 * 1024
+# send download fork data straight from memory-mapped files where sendfile isn't used, instead of reading (or caching)
+# it; keeps memory use flat for many large downloads over SSL. Files truncated mid-download end the transfer early.
+ENABLE_MMAP = False
+# download bandwidth caps in bytes/sec (0 = unlimited): for all downloads combined, for each account
+# (XFER_ACCOUNT_RATES maps logins to their own cap), and for each individual download
+XFER_GLOBAL_RATE = 0
+XFER_ACCOUNT_RATE = 0
+XFER_ACCOUNT_RATES = {}
+XFER_TRANSFER_RATE = 0
 
 ################################################################################
 # GIF icon options
@@ -4,11 +4,10 @@ from phxd.types import HLException
 
 def require_permission(perm, action):
     def _dec(handler_func):
-        def _checkperm(signal, sender, *args, **kwargs):
-            user = kwargs.get('user', None)
+        def _checkperm(server, user, packet):
             if user and not user.hasPriv(perm):
                 raise HLException("You do not have permission to %s." % action)
-            return handler_func(*args, **kwargs)
+            return handler_func(server, user, packet)
         return _checkperm
     return _dec
 
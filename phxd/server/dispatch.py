@@ -0,0 +1,59 @@
+from phxd.server.signals import packet_outgoing, packet_received
+
+
+class HLDispatchTable:
+    """ Maps packet types to the functions marked with packet_handler (for received packets) and packet_filter (for
+    outgoing packets), and calls them directly. A type of None matches every packet; those functions run first.
+    The tables of functions to call for each type are rebuilt whenever a function is connected or disconnected,
+    so dispatching a packet is a single dictionary lookup. """
+
+    def __init__(self):
+        # Maps (signal, packet type) to the list of connected functions, in the order they were connected.
+        self.connected = {}
+        self.handlers = {}
+        self.filters = {}
+        self.anyHandlers = ()
+        self.anyFilters = ()
+
+    def connect(self, func):
+        """ Connects a function marked with packet_handler or packet_filter. """
+        funcs = self.connected.setdefault(func._signal_type, [])
+        if func not in funcs:
+            funcs.append(func)
+            self.compile()
+
+    def disconnect(self, func):
+        funcs = self.connected.get(func._signal_type, [])
+        if func in funcs:
+            funcs.remove(func)
+            if not funcs:
+                del self.connected[func._signal_type]
+            self.compile()
+
+    def compile(self):
+        (self.handlers, self.anyHandlers) = self._compile(packet_received)
+        (self.filters, self.anyFilters) = self._compile(packet_outgoing)
+
+    def _compile(self, signal):
+        always = tuple(self.connected.get((signal, None), ()))
+        table = {}
+        for ((sig, ptype), funcs) in self.connected.items():
+            if (sig == signal) and (ptype is not None):
+                table[ptype] = always + tuple(funcs)
+        return (table, always)
+
+    def dispatch(self, server, user, packet):
+        """ Calls every handler for the packet's type. Exceptions (such as HLException) are left to the caller. """
+        for handler in self.handlers.get(packet.type, self.anyHandlers):
+            handler(server, user, packet)
+
+    def hasFilters(self, ptype):
+        return (ptype in self.filters) or (len(self.anyFilters) > 0)
+
+    def filter(self, server, packet, users):
+        """ Calls every filter for the packet's type, which may change the packet before it is sent to users. """
+        for func in self.filters.get(packet.type, self.anyFilters):
+            func(server, packet, users)
+
+
+dispatchTable = HLDispatchTable()
@@ -1,62 +1,316 @@
 from pydispatch import dispatcher
-from twisted.internet import task
+from twisted.internet import task, threads
 from twisted.internet.protocol import Factory
 
+from phxd.constants import *
+from phxd.packet import HLPacket
 from phxd.protocol import HLTransferProtocol
 from phxd.server.config import conf
 from phxd.server.signals import *
 from phxd.transfer import HLIncomingTransfer, HLOutgoingTransfer
+from phxd.types import HLException
 
+from collections import deque
+import heapq
 import logging
+import os
 import time
 
 
 class HLDownload (HLOutgoingTransfer):
+
+    # Position in the file server's admission queue, starting at 1, or 0 once the transfer has been admitted.
+    __slots__ = ('queuePosition',)
+
     def __str__(self):
-        kps = self.getTotalBPS() / 1024
-        return "[DL] %s @ %sk/sec (%s%%)" % (self.file.name, kps, self.overallPercent())
+        kps = self.getCurrentBPS() // 1024
+        avg = self.getTotalBPS() // 1024
+        return "[DL] %s @ %sk/sec, avg %sk/sec (%s%%)" % (self.file.name, kps, avg, self.overallPercent())
 
 
 class HLUpload (HLIncomingTransfer):
+
+    __slots__ = ('queuePosition',)
+
     def __str__(self):
-        kps = self.getTotalBPS() / 1024
-        return "[UL] %s @ %sk/sec (%s%%)" % (self.file.name, kps, self.overallPercent())
+        kps = self.getCurrentBPS() // 1024
+        avg = self.getTotalBPS() // 1024
+        return "[UL] %s @ %sk/sec, avg %sk/sec (%s%%)" % (self.file.name, kps, avg, self.overallPercent())
+
+
+class TokenBucket:
+    """ Refills at rate bytes per second, holding at most BURST seconds' worth. Sending is allowed while any tokens
+    are left, and the whole amount sent is taken out afterwards, so a bucket can briefly go into debt. """
+
+    BURST = 0.25
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate * self.BURST
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + ((now - self.last) * self.rate))
+        self.last = now
+
+
+class HLTransferShaper:
+    """ Shapes download bandwidth with a global bucket, a bucket per account, and a bucket per transfer. A download
+    sends while all of its buckets have tokens; otherwise it waits in a queue that is served round-robin every TICK,
+    up to QUANTUM bytes per transfer per turn, so throttled transfers share the available bandwidth fairly. """
+
+    TICK = 0.05
+    QUANTUM = 2 ** 16
+
+    def __init__(self):
+        self.globalBucket = None
+        self.accountBuckets = {}
+        self.shaped = set()
+        self.waiting = deque()
+        self.ticker = task.LoopingCall(self.tick)
+
+    def register(self, conn, login):
+        """ Gives conn the buckets that currently apply to a download for the specified account login. """
+        buckets = []
+        if conf.XFER_GLOBAL_RATE:
+            if (self.globalBucket is None) or (self.globalBucket.rate != conf.XFER_GLOBAL_RATE):
+                self.globalBucket = TokenBucket(conf.XFER_GLOBAL_RATE)
+            buckets.append(self.globalBucket)
+        rate = conf.XFER_ACCOUNT_RATES.get(login, conf.XFER_ACCOUNT_RATE)
+        if rate:
+            if (login not in self.accountBuckets) or (self.accountBuckets[login].rate != rate):
+                self.accountBuckets[login] = TokenBucket(rate)
+            buckets.append(self.accountBuckets[login])
+        if conf.XFER_TRANSFER_RATE:
+            buckets.append(TokenBucket(conf.XFER_TRANSFER_RATE))
+        conn.shaper = self
+        conn.buckets = buckets
+        if buckets:
+            self.shaped.add(conn)
+            if not self.ticker.running:
+                self.ticker.start(self.TICK, False)
+
+    def unregister(self, conn):
+        if conn in self.shaped:
+            self.shaped.remove(conn)
+            if conn in self.waiting:
+                self.waiting.remove(conn)
+            if not self.shaped:
+                self.ticker.stop()
+                self.accountBuckets = {}
+
+    def allowance(self, conn, now):
+        """ Returns how many bytes conn's buckets currently hold (the smallest of them), or 0 if any is empty. """
+        tokens = None
+        for bucket in conn.buckets:
+            bucket.refill(now)
+            if (tokens is None) or (bucket.tokens < tokens):
+                tokens = bucket.tokens
+        return max(0, int(tokens))
+
+    def consume(self, conn, size):
+        for bucket in conn.buckets:
+            bucket.tokens -= size
+
+    def schedule(self, conn):
+        """ Called when a shaped download's transport wants more data. Sends right away unless one of its own
+        buckets is empty; downloads held back by other buckets don't slow down the ones that aren't. """
+        allowance = self.allowance(conn, time.time())
+        if allowance > 0:
+            self.consume(conn, conn.produce(allowance))
+        else:
+            self.waiting.append(conn)
+
+    def tick(self):
+        now = time.time()
+        turns = len(self.waiting)
+        for _ in range(turns):
+            conn = self.waiting.popleft()
+            sent = 0
+            while sent < self.QUANTUM:
+                allowance = self.allowance(conn, now)
+                if allowance == 0:
+                    self.waiting.append(conn)
+                    break
+                # Leave a fair share of the tokens for everyone else waiting this turn.
+                size = conn.produce(max(self.QUANTUM // 4, allowance // turns))
+                self.consume(conn, size)
+                sent += size
+                # A sendfile download must wait for the transport to drain before sending again.
+                if (size == 0) or (conn.info.segments is not None):
+                    break
+
+    def totalBPS(self, transfers):
+        return sum(x.getCurrentBPS() for x in transfers if not x.isIncoming())
+
+
+class HLFileJobs:
+    """ Runs bulk filesystem work (deleting folders, moving across devices) in the thread pool, so the reactor never
+    waits on it. The paths a job works on are locked until it finishes: nothing at, above, or below a locked path
+    may be changed, so check should be called before changing anything. """
+
+    def __init__(self):
+        self.locked = {}
+
+    def conflicts(self, path, locked):
+        return (path == locked) or path.startswith(os.path.join(locked, '')) or locked.startswith(os.path.join(path, ''))
+
+    def check(self, *paths):
+        """ Raises a HLException if any of the paths overlap a path locked by a running job. """
+        for path in paths:
+            path = os.path.abspath(path)
+            for locked in self.locked:
+                if self.conflicts(path, locked):
+                    raise HLException("%s is busy, try again once the current operation on it finishes." % os.path.basename(path))
+
+    def run(self, paths, func, *args, **kwargs):
+        """ Locks paths, and calls func with the arguments in a pool thread. Returns a Deferred with the result. """
+        self.check(*paths)
+        paths = [os.path.abspath(path) for path in paths]
+        for path in paths:
+            self.locked[path] = self.locked.get(path, 0) + 1
+        d = threads.deferToThread(func, *args, **kwargs)
+        return d.addBoth(self._finished, paths)
+
+    def _finished(self, result, paths):
+        for path in paths:
+            self.locked[path] -= 1
+            if self.locked[path] <= 0:
+                del self.locked[path]
+        return result
+
+
+class HLTransferRegistry:
+    """ Pending and running transfers, indexed by transfer ID and by owner, with a heap of activity deadlines so
+    idle transfers can be found without looking at the rest. Iterating yields transfers in the order they were added. """
+
+    def __init__(self):
+        self.byID = {}
+        self.byOwner = {}
+        # (deadline, transfer ID) pairs. Entries are never updated in place; a transfer whose activity has moved
+        # its deadline is pushed again with the new deadline when the old one comes up.
+        self.deadlines = []
+
+    def __len__(self):
+        return len(self.byID)
+
+    def __iter__(self):
+        return iter(list(self.byID.values()))
+
+    def __contains__(self, x):
+        return (x is not None) and (self.byID.get(x.id) is x)
+
+    def add(self, x, timeout):
+        self.byID[x.id] = x
+        self.byOwner.setdefault(x.owner, []).append(x)
+        heapq.heappush(self.deadlines, (x.lastActivity + timeout, x.id))
+
+    def remove(self, x):
+        if x not in self:
+            return
+        del self.byID[x.id]
+        owned = self.byOwner[x.owner]
+        owned.remove(x)
+        if not owned:
+            del self.byOwner[x.owner]
+        # Its heap entry is dropped when it comes up.
+
+    def get(self, xfid):
+        return self.byID.get(xfid)
+
+    def forOwner(self, uid):
+        return list(self.byOwner.get(uid, ()))
+
+    def expired(self, now, timeout):
+        """ Returns the transfers that have been idle for longer than timeout. Queued transfers never expire. """
+        dead = []
+        while self.deadlines and (self.deadlines[0][0] <= now):
+            (deadline, xfid) = heapq.heappop(self.deadlines)
+            x = self.byID.get(xfid)
+            if x is None:
+                continue
+            if x.queuePosition > 0:
+                deadline = now + timeout
+            else:
+                deadline = x.lastActivity + timeout
+            if deadline <= now:
+                dead.append(x)
+            else:
+                heapq.heappush(self.deadlines, (deadline, xfid))
+        return dead
 
 
 class HLFileServer (Factory):
+    """ Factory for transfer connections. Also admits transfers, allowing at most MAX_XFERS transfers at once (and
+    MAX_XFERS_PER_USER for any one user); the rest wait in a FIFO queue, and their owners are kept informed of their
+    position in it. A transfer connection that arrives while its transfer is still queued is paused until it is admitted. """
 
     protocol = HLTransferProtocol
 
     def __init__(self, hlserver):
         self.lastTransferID = 0
-        self.transfers = []
+        self.transfers = HLTransferRegistry()
         self.server = hlserver
+        self.shaper = HLTransferShaper()
+        # Admitted transfers, per-user counts of them, queued transfers, and connections waiting on queued transfers.
+        self.active = set()
+        self.activeByUser = {}
+        self.queue = deque()
+        self.parked = {}
+        # Connections for started transfers, by transfer ID, so timed out transfers can be closed.
+        self.connections = {}
         self.tickle = task.LoopingCall(self.checkTransfers)
         self.tickle.start(5.0, False)
 
     # Notification methods called from HLTransferProtocol
 
     def notifyConnect(self, conn):
-        pass
+        conn.useSendfile = conf.ENABLE_SENDFILE
+        conn.readAhead = conf.XFER_READAHEAD
+        conn.useMmap = conf.ENABLE_MMAP
 
     def notifyDisconnect(self, conn):
+        self.shaper.unregister(conn)
+        for xfid, parked in list(self.parked.items()):
+            if parked is conn:
+                # The client gave up waiting in the queue.
+                del self.parked[xfid]
+                x = self.transfers.get(xfid)
+                if x is not None:
+                    logging.info("[xfer] aborted while queued %s", x)
+                    self.removeTransfer(x)
         if conn.info in self.transfers:
             if conn.info.isComplete():
                 logging.info("[xfer] completed %s", conn.info)
                 dispatcher.send(signal=transfer_completed, sender=self, server=self.server, transfer=conn.info)
-                self.transfers.remove(conn.info)
             else:
                 logging.info("[xfer] aborted %s", conn.info)
                 dispatcher.send(signal=transfer_aborted, sender=self, server=self.server, transfer=conn.info)
-                self.transfers.remove(conn.info)
+            self.removeTransfer(conn.info)
 
     def notifyMagic(self, conn, xfid, size, flags):
-        for x in self.transfers:
-            if x.id == xfid:
-                if x.isIncoming() and x.total == 0:
-                    x.total = size
-                conn.start(x)
-                dispatcher.send(signal=transfer_started, sender=self, server=self.server, transfer=x)
+        x = self.transfers.get(xfid)
+        if (x is None) or (x.id in self.parked) or (x.id in self.connections):
+            # Unknown transfer, or another connection already claimed it.
+            conn.transport.loseConnection()
+            return
+        if x.isIncoming() and x.total == 0:
+            x.total = size
+        if x.queuePosition > 0:
+            # Not our turn yet; stop reading until the transfer is admitted.
+            conn.transport.pauseProducing()
+            self.parked[x.id] = conn
+        else:
+            self.startTransfer(conn, x)
+
+    def startTransfer(self, conn, x):
+        if not x.isIncoming():
+            owner = self.server.getUser(x.owner)
+            self.shaper.register(conn, owner.account.login if owner else None)
+        self.connections[x.id] = conn
+        conn.start(x)
+        dispatcher.send(signal=transfer_started, sender=self, server=self.server, transfer=x)
 
     # Convenience methods called from the file handler
 
@@ -64,23 +318,93 @@ class HLFileServer (Factory):
         self.lastTransferID += 1
         info = HLUpload(self.lastTransferID, file)
         info.owner = user.uid
-        self.transfers.append(info)
+        self.transfers.add(info, conf.XFER_TIMEOUT)
+        self.admitTransfer(info)
         return info
 
     def addDownload(self, user, file, resume, options):
         self.lastTransferID += 1
         info = HLDownload(self.lastTransferID, file, resume, options)
         info.owner = user.uid
-        self.transfers.append(info)
+        self.transfers.add(info, conf.XFER_TIMEOUT)
+        self.admitTransfer(info)
         return info
 
+    # Admission queue
+
+    def canAdmit(self, uid):
+        if conf.MAX_XFERS and (len(self.active) >= conf.MAX_XFERS):
+            return False
+        if conf.MAX_XFERS_PER_USER and (self.activeByUser.get(uid, 0) >= conf.MAX_XFERS_PER_USER):
+            return False
+        return True
+
+    def admitTransfer(self, x):
+        """ Admits a new transfer if there is room for it, otherwise adds it to the end of the queue. Anything already
+        queued is held back by its owner's limit whenever there is a free slot, so this never jumps ahead of it. """
+        if self.canAdmit(x.owner):
+            self.activate(x)
+        else:
+            self.queue.append(x)
+            x.queuePosition = len(self.queue)
+
+    def activate(self, x):
+        x.queuePosition = 0
+        x.lastActivity = time.time()
+        self.active.add(x)
+        self.activeByUser[x.owner] = self.activeByUser.get(x.owner, 0) + 1
+
+    def removeTransfer(self, x):
+        """ Forgets about a finished, aborted, or timed out transfer, and lets in whatever can now be admitted. """
+        self.transfers.remove(x)
+        self.connections.pop(x.id, None)
+        if x in self.active:
+            self.active.remove(x)
+            self.activeByUser[x.owner] -= 1
+            if self.activeByUser[x.owner] <= 0:
+                del self.activeByUser[x.owner]
+        elif x in self.queue:
+            self.queue.remove(x)
+        self.advanceQueue()
+
+    def advanceQueue(self):
+        """ Admits queued transfers in FIFO order (skipping those whose owner is at the per-user limit),
+        then tells the owners of the rest about their new queue positions. """
+        waiting = deque()
+        while self.queue:
+            x = self.queue.popleft()
+            if self.server.getUser(x.owner) is None:
+                # The owner has left, so nobody will ever connect for this transfer.
+                self.transfers.remove(x)
+                conn = self.parked.pop(x.id, None)
+                if conn is not None:
+                    conn.transport.abortConnection()
+            elif self.canAdmit(x.owner):
+                self.activate(x)
+                self.sendQueuePosition(x)
+                conn = self.parked.pop(x.id, None)
+                if conn is not None:
+                    conn.transport.resumeProducing()
+                    self.startTransfer(conn, x)
+            else:
+                waiting.append(x)
+                if x.queuePosition != len(waiting):
+                    x.queuePosition = len(waiting)
+                    self.sendQueuePosition(x)
+        self.queue = waiting
+
+    def sendQueuePosition(self, x):
+        update = HLPacket(HTLS_HDR_XFER_QUEUE)
+        update.addNumber(DATA_XFERID, x.id)
+        update.addNumber(DATA_WAITINGCOUNT, x.queuePosition)
+        self.server.sendPacket(update, x.owner)
+
     def checkTransfers(self):
-        # TODO: when a transfer times out, close it's transport connection
-        deadlist = []
-        now = time.time()
-        for x in self.transfers:
-            if (now - x.lastActivity) > conf.XFER_TIMEOUT:
-                deadlist.append(x)
-        for dead in deadlist:
+        for dead in self.transfers.expired(time.time(), conf.XFER_TIMEOUT):
             logging.info("[xfer] timed out %s", dead)
-            self.transfers.remove(dead)
+            conn = self.connections.get(dead.id)
+            if conn is not None:
+                # The transfer is removed (and reported aborted) when the connection goes away.
+                conn.transport.abortConnection()
+            else:
+                self.removeTransfer(dead)
@@ -1,4 +1,4 @@
-from pydispatch import dispatcher
+from phxd.server.dispatch import dispatchTable
 
 import logging
 import sys
@@ -24,7 +24,7 @@ def install(mod_base, mod_name):
         for name in dir(mod):
             obj = getattr(mod, name)
             if callable(obj) and hasattr(obj, "_signal_type"):
-                dispatcher.connect(obj, signal=obj._signal_type)
+                dispatchTable.connect(obj)
         if hasattr(mod, "install") and callable(mod.install):
             mod.install()
 
@@ -37,7 +37,7 @@ def uninstall(mod_base, mod_name):
         for name in dir(mod):
             obj = getattr(mod, name)
             if callable(obj) and hasattr(obj, "_signal_type"):
-                dispatcher.disconnect(obj, signal=obj._signal_type)
+                dispatchTable.disconnect(obj)
         if hasattr(mod, "uninstall") and callable(mod.uninstall):
             mod.uninstall()
         del sys.modules[mod_path]
@@ -44,8 +44,8 @@ def handleAccountModify(server, user, packet):
     if pw_data != "\x00":
         acct.password = hashlib.md5(HLDecode(pw_data).encode('utf-8')).hexdigest()
     server.database.saveAccount(acct)
+    server.updateAccount(acct)
     server.sendPacket(packet.response(), user)
-    # server.updateAccounts( acct )
     logging.info("[account] %s modified by %s", login, user)
 
 
@@ -3,13 +3,13 @@ from pydispatch import dispatcher
 from phxd.constants import *
 from phxd.packet import HLPacket
 from phxd.permissions import *
+from phxd.server.commands import commands
 from phxd.server.config import conf
 from phxd.server.decorators import *
 from phxd.server.signals import *
 from phxd.types import HLException
 
 import logging
-import sys
 
 
 def install():
@@ -28,15 +28,12 @@ def _dispatchCommand(server, user, line, ref):
         args = ""
         if len(parts) > 1:
             args = parts[1]
-        mod_path = "phxd.server.commands.%s" % cmd
-        try:
-            if mod_path in sys.modules:
-                del sys.modules[mod_path]
-            mod = __import__(mod_path, None, None, "phxd.server.commands")
-            handler = getattr(mod, "handle")
-            handler(server, user, args, ref)
-        except Exception as e:
-            logging.error("%s: %s", mod_path, e)
+        handler = commands.get(cmd)
+        if handler is not None:
+            try:
+                handler(server, user, args, ref)
+            except Exception as e:
+                logging.error("phxd.server.commands.%s: %s", cmd, e)
         return True
     return False
 
@@ -55,8 +52,7 @@ def handleUserDisconnected(server, user):
                 leave = HLPacket(HTLS_HDR_CHAT_USER_LEAVE)
                 leave.addInt32(DATA_CHATID, chat.id)
                 leave.addNumber(DATA_UID, user.uid)
-                for u in chat.users:
-                    server.sendPacket(leave, u)
+                server.sendPacket(leave, [u.uid for u in chat.users])
             else:
                 # Otherwise, mark the chat as dead.
                 deadChats.append(chat.id)
@@ -96,11 +92,10 @@ def handleChat(server, user, packet):
                     # If this is meant for a private chat, add the chat ID
                     # and send it to everyone in the chat.
                     chat.addInt32(DATA_CHATID, pchat.id)
-                    for u in pchat.users:
-                        server.sendPacket(chat, u)
+                    server.sendPacket(chat, [u.uid for u in pchat.users])
                 else:
                     # Otherwise, send it to public chat (and log it).
-                    server.sendPacket(chat, lambda c: c.context.hasPriv(PRIV_READ_CHAT))
+                    server.sendPacket(chat, 'chat')
 
 
 @packet_handler(HTLC_HDR_CHAT_CREATE)
@@ -179,8 +174,7 @@ def handleChatDecline(server, user, packet):
         decline = HLPacket(HTLS_HDR_CHAT)
         decline.addInt32(DATA_CHATID, chat.id)
         decline.addString(DATA_STRING, s)
-        for u in chat.users:
-            server.sendPacket(decline, u)
+        server.sendPacket(decline, [u.uid for u in chat.users])
 
 
 @packet_handler(HTLC_HDR_CHAT_JOIN)
@@ -202,8 +196,7 @@ def handleChatJoin(server, user, packet):
     join.addNumber(DATA_STATUS, user.status)
     if user.color >= 0:
         join.addInt32(DATA_COLOR, user.color)
-    for u in chat.users:
-        server.sendPacket(join, u)
+    server.sendPacket(join, [u.uid for u in chat.users])
 
     # Add the joiner to the chat.
     chat.addUser(user)
@@ -230,8 +223,7 @@ def handleChatLeave(server, user, packet):
         leave = HLPacket(HTLS_HDR_CHAT_USER_LEAVE)
         leave.addInt32(DATA_CHATID, chat.id)
         leave.addNumber(DATA_UID, user.uid)
-        for u in chat.users:
-            server.sendPacket(leave, u)
+        server.sendPacket(leave, [u.uid for u in chat.users])
     else:
         server.removeChat(chat.id)
 
@@ -248,5 +240,4 @@ def handleChatSubject(server, user, packet):
     subject = HLPacket(HTLS_HDR_CHAT_SUBJECT)
     subject.addInt32(DATA_CHATID, ref)
     subject.addString(DATA_SUBJECT, sub)
-    for u in chat.users:
-        server.sendPacket(subject, u)
+    server.sendPacket(subject, [u.uid for u in chat.users])
@@ -11,15 +11,25 @@ from phxd.utils import HLEncodeDate, decodeString
 
 from datetime import datetime
 from struct import unpack
+import logging
 import os
 
 
 def install():
     dispatcher.connect(handleTransferFinished, signal=transfer_completed)
+    dispatcher.connect(handleTransferEnded, signal=transfer_completed)
+    dispatcher.connect(handleTransferEnded, signal=transfer_aborted)
 
 
 def uninstall():
     dispatcher.disconnect(handleTransferFinished, signal=transfer_completed)
+    dispatcher.disconnect(handleTransferEnded, signal=transfer_completed)
+    dispatcher.disconnect(handleTransferEnded, signal=transfer_aborted)
+
+
+def handleTransferEnded(server, transfer):
+    if transfer.isIncoming():
+        server.fileChanged(transfer.file.dataPath)
 
 
 def handleTransferFinished(server, transfer):
@@ -68,6 +78,20 @@ def buildPath(root, d, file=None):
     return os.path.join(*pathArray)
 
 
+def replyWhenDone(server, user, packet, d):
+    """ Sends the reply to packet once the Deferred d fires, or an error if it fails. """
+    def done(result):
+        server.sendPacket(packet.response(), user)
+
+    def failed(failure):
+        if failure.check(HLException):
+            server.sendPacket(packet.error(failure.value.msg), user)
+        else:
+            logging.error("[files] task %x failed: %s", packet.type, failure.getErrorMessage())
+            server.sendPacket(packet.error(failure.getErrorMessage()), user)
+    d.addCallbacks(done, failed)
+
+
 # handler methods
 
 
@@ -84,13 +108,8 @@ def handleFileList(server, user, packet):
         raise HLException("You are not allowed to view drop boxes.")
 
     reply = packet.response()
-    files = os.listdir(path)
-    files.sort()
-    for fname in files:
-        if conf.SHOW_DOTFILES or (fname[0] != '.'):
-            # Only list files starting with . if SHOW_DOTFILES is True.
-            file = HLFile(os.path.join(path, fname))
-            reply.addBinary(DATA_FILE, file.flatten())
+    for data in server.listings.get(path):
+        reply.addBinary(DATA_FILE, data)
     server.sendPacket(reply, user)
 
 
@@ -105,6 +124,7 @@ def handleFileDownload(server, user, packet):
     path = buildPath(user.account.fileRoot, dir, name)
     if not os.path.exists(path):
         raise HLException("Specified file does not exist.")
+    server.filejobs.check(path)
 
     file = HLFile(path)
     xfer = server.fileserver.addDownload(user, file, resume, options)
@@ -114,6 +134,8 @@ def handleFileDownload(server, user, packet):
     reply.addNumber(DATA_XFERSIZE, xfer.total)
     reply.addNumber(DATA_FILESIZE, dataSize)
     reply.addNumber(DATA_XFERID, xfer.id)
+    if xfer.queuePosition > 0:
+        reply.addNumber(DATA_WAITINGCOUNT, xfer.queuePosition)
     server.sendPacket(reply, user)
 
 
@@ -128,6 +150,7 @@ def handleFileUpload(server, user, packet):
     path = buildPath(user.account.fileRoot, dir, name)
     if os.path.exists(path):
         raise HLException("File already exists.")
+    server.filejobs.check(path)
     if (not user.hasPriv(PRIV_UPLOAD_ANYWHERE)) and (path.upper().find("UPLOAD") < 0 or path.upper().find("DROP BOX") < 0):
         raise HLException("You must upload to an upload directory or drop box.")
 
@@ -141,9 +164,12 @@ def handleFileUpload(server, user, packet):
     file = HLFile(path)
     xfer = server.fileserver.addUpload(user, file)
     xfer.total = size
+    server.fileChanged(path)
 
     reply = packet.response()
     reply.addNumber(DATA_XFERID, xfer.id)
+    if xfer.queuePosition > 0:
+        reply.addNumber(DATA_WAITINGCOUNT, xfer.queuePosition)
     if file.exists():
         reply.addBinary(DATA_RESUME, file.resumeData().flatten())
     server.sendPacket(reply, user)
@@ -156,23 +182,21 @@ def handleFileDelete(server, user, packet):
     path = buildPath(user.account.fileRoot, dir, name)
     if not os.path.exists(path):
         raise HLException("Specified file or directory does not exist.")
-    if os.path.isdir(path):
+    server.filejobs.check(path)
+    file = HLFile(path)
+    if file.isdir():
         if not user.hasPriv(PRIV_DELETE_FOLDERS):
             raise HLException("You are not allowed to delete folders.")
-        # First, recursively delete everything inside the directory.
-        for (root, dirs, files) in os.walk(path, topdown=False):
-            for name in files:
-                os.unlink(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        # Then delete the directory itself.
-        os.rmdir(path)
+        # Folders may hold any number of files, so delete them in the background and reply once done.
+        d = server.filejobs.run([path], file.delete)
+        d.addCallback(lambda _: server.fileChanged(path))
+        replyWhenDone(server, user, packet, d)
     else:
         if not user.hasPriv(PRIV_DELETE_FILES):
             raise HLException("You are not allowed to delete files.")
-        file = HLFile(path)
         file.delete()
-    server.sendPacket(packet.response(), user)
+        server.fileChanged(path)
+        server.sendPacket(packet.response(), user)
 
 
 @packet_handler(HTLC_HDR_FILE_MKDIR)
@@ -183,7 +207,9 @@ def handleFolderCreate(server, user, packet):
     path = buildPath(user.account.fileRoot, dir, name)
     if os.path.exists(path):
         raise HLException("Specified directory already exists.")
+    server.filejobs.check(path)
     os.mkdir(path, conf.DIR_UMASK)
+    server.fileChanged(path)
     server.sendPacket(packet.response(), user)
 
 
@@ -202,10 +228,19 @@ def handleFileMove(server, user, packet):
     if os.path.exists(newPath):
         raise HLException("The specified file already exists in the new location.")
 
-    file = HLFile(oldPath)
-    file.rename(newPath)
+    server.filejobs.check(oldPath, newPath)
 
-    server.sendPacket(packet.response(), user)
+    file = HLFile(oldPath)
+    if file.isSameDevice(newPath):
+        file.rename(newPath)
+        server.fileChanged(oldPath)
+        server.fileChanged(newPath)
+        server.sendPacket(packet.response(), user)
+    else:
+        # Moving to another device means copying everything; do that in the background and reply once done.
+        d = server.filejobs.run([oldPath, newPath], file.rename, newPath)
+        d.addCallback(lambda _: (server.fileChanged(oldPath), server.fileChanged(newPath)))
+        replyWhenDone(server, user, packet, d)
 
 
 @packet_handler(HTLC_HDR_FILE_GETINFO)
@@ -248,9 +283,13 @@ def handleFileSetInfo(server, user, packet):
         raise HLException("Invalid file or directory.")
     if (oldPath != newPath) and os.path.exists(newPath):
         raise HLException("The specified file already exists.")
+    server.filejobs.check(oldPath, newPath)
 
     file = HLFile(oldPath)
-    file.rename(newPath)
+    if newPath != oldPath:
+        file.rename(newPath)
+        server.fileChanged(oldPath)
     file.setComment(comment)
+    server.fileChanged(newPath)
 
     server.sendPacket(packet.response(), user)
@@ -41,7 +41,7 @@ def handleNewsPost(server, user, packet):
         server.database.saveNewsPost(post)
         notify = HLPacket(HTLS_HDR_NEWS_POST)
         notify.addString(DATA_STRING, formatPost(post))
-        server.sendPacket(notify, lambda c: c.context.hasPriv(PRIV_READ_NEWS))
+        server.sendPacket(notify, 'news')
         server.sendPacket(packet.response(), user)
 
 # Avaraline extensions
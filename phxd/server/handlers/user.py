@@ -50,7 +50,7 @@ def handleLogin(server, user, packet):
 
     # Handle the nickname/icon/color stuff, broadcast the join packet.
     handleUserChange(server, user, packet)
-    user.valid = True
+    server.addSession(user)
     user.account.lastLogin = datetime.now()
 
     dispatcher.send(signal=user_login, sender=server, server=server, user=user)
@@ -108,12 +108,10 @@ def handleUserInfo(server, user, packet):
     idle = formatElapsedTime(time.time() - who.lastPacketTime)
     info = fmt % (who.nick, who.uid, who.account.login, who.account.name, who.ip, idle)
     info += "--------------------------------\r"
-    num = 0
-    for xfer in server.fileserver.transfers:
-        if xfer.owner == uid:
-            info += str(xfer) + "\r"
-            num += 1
-    if num < 1:
+    xfers = server.fileserver.transfers.forOwner(uid)
+    for xfer in xfers:
+        info += str(xfer) + "\r"
+    if not xfers:
         info += "No file transfers.\r"
     info += "--------------------------------\r"
 
@@ -153,7 +151,8 @@ def handleUserKick(server, user, packet):
 
 @packet_handler(HTLC_HDR_PING)
 def handlePing(server, user, packet):
-    server.sendPacket(packet.response(), user)
+    # Clients use ping replies to measure latency, so don't hold them back for coalescing.
+    server.sendPacket(packet.response(), user, immediate=True)
 
 # Avaraline extensions
 
@@ -0,0 +1,150 @@
+from phxd.metadata import NO_METADATA, metadataStore
+from phxd.server.config import conf
+from phxd.types import HLFile
+
+from collections import OrderedDict
+import logging
+import os
+import time
+
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+    from phxd.server.utils import HLNotifier
+except ImportError:
+    inotify = None
+
+
+class HLListingCache:
+    """ Caches the flattened DATA_FILE objects for recently listed directories, keeping at most maxDirs of them.
+    Where inotify is available, each cached directory (and each folder in it, whose item count it shows) is watched
+    and its listing dropped as soon as anything in it changes. A listing is also rebuilt whenever the directory's
+    mtime has changed, and without a watch, once it is older than maxAge. The file handlers call changed() for their
+    own changes, so those show up right away. """
+
+    if inotify is not None:
+        # Events for entries coming or going, which change their directory's item count.
+        ENTRY_MASK = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+        WATCH_MASK = ENTRY_MASK | inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_MOVE_SELF
+
+    def __init__(self, maxDirs, maxAge):
+        self.maxDirs = maxDirs
+        self.maxAge = maxAge
+        # Maps directory path to (mtime, build time, list of flattened files, watched paths, whether every watch we
+        # wanted was added), least recently used first.
+        self.listings = OrderedDict()
+        # Maps watched paths to the number of listings relying on the watch.
+        self.watched = {}
+        self.notifier = None
+        self.hits = 0
+        self.misses = 0
+        if (inotify is not None) and (maxDirs > 0):
+            try:
+                self.notifier = HLNotifier()
+                self.notifier.startReading()
+            except Exception as e:
+                logging.info("[files] inotify unavailable, validating listings by mtime: %s", e)
+                self.notifier = None
+
+    def get(self, path):
+        """ Returns a list of flattened HLFile objects for the directory at path, sorted by name. """
+        path = os.path.normpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self.listings.get(path)
+        if entry is not None:
+            (stamp, built, files, watches, watchedAll) = entry
+            if (stamp == mtime) and (watchedAll or ((time.time() - built) < self.maxAge)):
+                self.listings.move_to_end(path)
+                self.hits += 1
+                return files
+            self.drop(path)
+        self.misses += 1
+        if self.maxDirs <= 0:
+            return self.build(path)[0]
+        # Watch before listing, so nothing that changes while we list is missed.
+        watches = [path] if self.watch(path) else []
+        built = time.time()
+        (files, folders) = self.build(path)
+        for folder in folders:
+            if self.watch(folder):
+                watches.append(folder)
+        self.listings[path] = (mtime, built, files, watches, len(watches) == len(folders) + 1)
+        while len(self.listings) > self.maxDirs:
+            self.drop(next(iter(self.listings)))
+        return files
+
+    def build(self, path):
+        """ Returns the flattened files in the directory at path, and the paths of the folders among them. """
+        files = []
+        folders = []
+        # Look up the metadata for the whole directory at once, rather than file by file.
+        metadata = metadataStore.listDir(path) if metadataStore.isOpen() else None
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if conf.SHOW_DOTFILES or (entry.name[0] != '.'):
+                # Only list files starting with . if SHOW_DOTFILES is True.
+                file = HLFile(entry.path, metadata.get(entry.name, NO_METADATA) if metadata is not None else None)
+                files.append(file.flatten())
+                if entry.is_dir():
+                    folders.append(entry.path)
+        return (files, folders)
+
+    def changed(self, path):
+        """ Drops any listing that something being created, modified, or removed at path could affect: the directory
+        it is in, that directory's parent (which shows its item count), and if it is a directory, itself and
+        everything under it. """
+        path = os.path.normpath(path)
+        parent = os.path.dirname(path)
+        self.drop(parent)
+        self.drop(os.path.dirname(parent))
+        prefix = os.path.join(path, '')
+        for cached in [p for p in self.listings if (p == path) or p.startswith(prefix)]:
+            self.drop(cached)
+
+    def drop(self, path):
+        entry = self.listings.pop(path, None)
+        if entry is not None:
+            for watched in entry[3]:
+                self.unwatch(watched)
+
+    def watch(self, path):
+        """ Watches path for changes, returning True if it is now watched. """
+        if self.notifier is None:
+            return False
+        if path in self.watched:
+            self.watched[path] += 1
+            return True
+        try:
+            self.notifier.watch(FilePath(path), self.WATCH_MASK, callbacks=[self.notify])
+        except Exception as e:
+            # Most likely out of watches; this directory falls back to mtime checks.
+            logging.debug("[files] unable to watch %s: %s", path, e)
+            return False
+        self.watched[path] = 1
+        return True
+
+    def unwatch(self, path):
+        self.watched[path] -= 1
+        if self.watched[path] <= 0:
+            del self.watched[path]
+            try:
+                self.notifier.ignore(FilePath(path))
+            except (KeyError, OSError):
+                # The kernel already removed it, along with the directory.
+                pass
+
+    def notify(self, watch, filepath, mask):
+        path = os.fsdecode(filepath.path)
+        parent = os.path.dirname(path)
+        if (mask & inotify.IN_MOVE_SELF) or ((mask & inotify.IN_ISDIR) and (mask & self.ENTRY_MASK)):
+            # A folder came, went, or moved, taking any listings under it along.
+            self.changed(path)
+        elif mask & self.ENTRY_MASK:
+            # A file came or went: its directory lists it, and that directory's parent shows its item count.
+            self.drop(parent)
+            self.drop(os.path.dirname(parent))
+        else:
+            # Something was written to or had its attributes changed, which only shows in its own directory.
+            self.drop(parent)
+
+    def stats(self):
+        return (self.hits, self.misses, len(self.listings))
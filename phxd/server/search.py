@@ -0,0 +1,284 @@
+from twisted.internet import reactor, threads
+
+from phxd.server.config import conf
+
+from array import array
+import logging
+import os
+
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+    from phxd.server.utils import HLNotifier
+except ImportError:
+    inotify = None
+
+
+FILE = 0
+FOLDER = 1
+GONE = 2
+
+
+class HLFileIndex:
+    """ Filename index for one directory tree, for case-insensitive substring searches. Every file and folder gets
+    an ID; each trigram of a (casefolded) name maps to the IDs of names containing it, so a search only checks the
+    names under its rarest trigram. Removed entries are marked GONE rather than taken out of the trigram lists.
+    Only touched from the reactor thread; walking the tree happens in the thread pool. """
+
+    BATCH_SIZE = 512
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.names = ['']
+        self.folded = ['']
+        self.parents = array('l', [-1])
+        self.kinds = bytearray([FOLDER])
+        # Maps folder IDs to {name: ID} for the entries in them.
+        self.children = {0: {}}
+        self.trigrams = {}
+        self.live = 0
+        self.gone = 0
+        self.ready = False
+        self.notifier = None
+        if inotify is not None:
+            try:
+                self.notifier = HLNotifier()
+                self.notifier.startReading()
+            except Exception as e:
+                logging.info("[files] inotify unavailable, search index kept current by file handlers only: %s", e)
+                self.notifier = None
+
+    def build(self):
+        """ Indexes the whole tree in the background. Returns a Deferred that fires once it is done. """
+        d = self.scan(0)
+
+        def built(result):
+            self.ready = True
+            logging.info("[files] indexed %d files and folders under %s", self.live, self.root)
+            return self
+        return d.addCallback(built)
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+
+    # Walking the tree
+
+    def scan(self, folderID):
+        """ Walks the folder with the specified ID in a pool thread, adding what it finds in batches. """
+        top = self.pathOf(folderID)
+        self.watch(top)
+        return threads.deferToThread(self._walk, top, folderID)
+
+    def _walk(self, top, topID):
+        # Runs in a pool thread, handing (relative folder path, [(name, isFolder)]) batches to the reactor thread.
+        batch = []
+        count = 0
+        for (dirpath, dirs, files) in os.walk(top):
+            if not conf.SHOW_DOTFILES:
+                dirs[:] = [name for name in dirs if name[0] != '.']
+                files = [name for name in files if name[0] != '.']
+            entries = [(name, True) for name in dirs] + [(name, False) for name in files]
+            batch.append((os.path.relpath(dirpath, top), entries))
+            count += len(entries) + 1
+            if count >= self.BATCH_SIZE:
+                reactor.callFromThread(self._addBatch, topID, batch)
+                batch = []
+                count = 0
+        # This lands before the Deferred for the walk fires, since both go through callFromThread.
+        reactor.callFromThread(self._addBatch, topID, batch)
+
+    def _addBatch(self, topID, batch):
+        for (rel, entries) in batch:
+            folderID = topID if rel == '.' else self.lookup(rel.split(os.sep), topID)
+            if (folderID is None) or (self.kinds[folderID] != FOLDER):
+                continue
+            if folderID != topID:
+                self.watch(self.pathOf(folderID))
+            for (name, isFolder) in entries:
+                self.add(folderID, name, isFolder)
+
+    # Maintaining the index
+
+    def add(self, parentID, name, isFolder):
+        """ Adds an entry to a folder, returning (ID, added), where added is False if it was already there. """
+        kind = FOLDER if isFolder else FILE
+        existing = self.children[parentID].get(name)
+        if existing is not None:
+            if self.kinds[existing] == kind:
+                return (existing, False)
+            self.remove(existing)
+        entryID = len(self.names)
+        folded = name.casefold()
+        self.names.append(name)
+        self.folded.append(folded)
+        self.parents.append(parentID)
+        self.kinds.append(kind)
+        self.children[parentID][name] = entryID
+        if isFolder:
+            self.children[entryID] = {}
+        for gram in set(folded[i:i + 3] for i in range(len(folded) - 2)):
+            ids = self.trigrams.get(gram)
+            if ids is None:
+                ids = self.trigrams[gram] = array('L')
+            ids.append(entryID)
+        self.live += 1
+        return (entryID, True)
+
+    def remove(self, entryID):
+        """ Removes an entry, and everything under it if it is a folder. """
+        del self.children[self.parents[entryID]][self.names[entryID]]
+        pending = [entryID]
+        while pending:
+            entryID = pending.pop()
+            if self.kinds[entryID] == FOLDER:
+                pending.extend(self.children.pop(entryID).values())
+            self.kinds[entryID] = GONE
+            self.live -= 1
+            self.gone += 1
+
+    def lookup(self, parts, entryID=0):
+        for part in parts:
+            entryID = self.children.get(entryID, {}).get(part)
+            if entryID is None:
+                return None
+        return entryID
+
+    def pathOf(self, entryID, top=0):
+        parts = []
+        while entryID != top:
+            parts.append(self.names[entryID])
+            entryID = self.parents[entryID]
+        parts.append(self.root if top == 0 else self.pathOf(top))
+        return os.path.join(*reversed(parts))
+
+    def contains(self, path):
+        return (path == self.root) or path.startswith(os.path.join(self.root, ''))
+
+    def changed(self, path):
+        """ Brings the index up to date for whatever is (or isn't) at path now. """
+        path = os.path.abspath(path)
+        if (path == self.root) or not self.contains(path):
+            return
+        (head, name) = os.path.split(os.path.relpath(path, self.root))
+        if (name[0] == '.') and not conf.SHOW_DOTFILES:
+            return
+        parentID = self.lookup(head.split(os.sep)) if head else 0
+        if (parentID is None) or (self.kinds[parentID] != FOLDER):
+            # Its folder isn't indexed (yet), so neither is it; whatever adds the folder will find it.
+            return
+        if os.path.lexists(path):
+            (entryID, added) = self.add(parentID, name, os.path.isdir(path))
+            if added and (self.kinds[entryID] == FOLDER):
+                self.scan(entryID).addErrback(logging.error)
+        else:
+            entryID = self.children[parentID].get(name)
+            if entryID is not None:
+                self.remove(entryID)
+
+    # Watching for changes
+
+    def watch(self, path):
+        if self.notifier is None:
+            return
+        mask = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+        try:
+            self.notifier.watch(FilePath(path), mask, callbacks=[self.notify])
+        except Exception as e:
+            # Most likely out of watches; this folder is only kept current by the file handlers.
+            logging.debug("[files] unable to watch %s: %s", path, e)
+
+    def notify(self, watch, filepath, mask):
+        self.changed(os.fsdecode(filepath.path))
+
+    # Searching
+
+    def search(self, top, text, offset, limit):
+        """ Returns ([(path, isFolder)], more) for up to limit entries under the folder top (a path) whose names contain
+        text, ignoring case, skipping the first offset matches. Paths are relative to top. more is True if there are
+        more matches after these. """
+        top = os.path.abspath(top)
+        topID = 0 if top == self.root else self.lookup(os.path.relpath(top, self.root).split(os.sep))
+        if topID is None:
+            return ([], False)
+        needle = text.casefold()
+        if len(needle) >= 3:
+            candidates = None
+            for gram in set(needle[i:i + 3] for i in range(len(needle) - 2)):
+                ids = self.trigrams.get(gram)
+                if ids is None:
+                    return ([], False)
+                if (candidates is None) or (len(ids) < len(candidates)):
+                    candidates = ids
+        else:
+            candidates = range(1, len(self.names))
+        results = []
+        skipped = 0
+        for entryID in candidates:
+            if (self.kinds[entryID] == GONE) or (needle not in self.folded[entryID]):
+                continue
+            if (topID != 0) and not self.isUnder(entryID, topID):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(results) == limit:
+                return (results, True)
+            results.append((self.pathOf(entryID, topID)[len(top):], self.kinds[entryID] == FOLDER))
+        return (results, False)
+
+    def isUnder(self, entryID, folderID):
+        while entryID > 0:
+            entryID = self.parents[entryID]
+            if entryID == folderID:
+                return True
+        return False
+
+
+class HLFileSearch:
+    """ Keeps a HLFileIndex for the file root, plus one for any account file root outside it, and rebuilds an
+    index in the background once most of its entries have been removed. """
+
+    def __init__(self):
+        # Maps root paths to their HLFileIndex (which may still be building), and to replacements being built.
+        self.indexes = {}
+        self.rebuilding = {}
+
+    def start(self, root):
+        self.indexFor(root)
+
+    def indexFor(self, root):
+        root = os.path.abspath(root)
+        for index in self.indexes.values():
+            if index.contains(root):
+                return index
+        index = self.indexes[root] = HLFileIndex(root)
+        index.build().addErrback(logging.error)
+        return index
+
+    def rebuild(self, root):
+        index = self.rebuilding[root] = HLFileIndex(root)
+        index.build().addCallbacks(self._rebuilt, logging.error)
+
+    def _rebuilt(self, index):
+        del self.rebuilding[index.root]
+        self.indexes[index.root].close()
+        self.indexes[index.root] = index
+
+    def changed(self, path):
+        path = os.path.abspath(path)
+        for index in list(self.indexes.values()) + list(self.rebuilding.values()):
+            if index.contains(path):
+                index.changed(path)
+        for (root, index) in list(self.indexes.items()):
+            if index.ready and (root not in self.rebuilding) and (index.gone > max(index.live, 10000)):
+                # Searching through that many removed entries is a waste; start over.
+                self.rebuild(root)
+
+    def search(self, root, text, offset, limit):
+        """ Searches the tree at root (see HLFileIndex.search), returning None if it is still being indexed. """
+        index = self.indexFor(root)
+        if not index.ready:
+            return None
+        return index.search(root, text, offset, limit)
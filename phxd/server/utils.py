@@ -1,6 +1,27 @@
 from phxd.server.config import conf
 from phxd.types import HLException
 
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+
+if inotify is not None:
+    class HLNotifier (inotify.INotify):
+        """ INotify that stays open when one of its watched directories is deleted, where Twisted's closes itself
+        (dropping every other watch along with it). Call close to close it. """
+
+        closing = False
+
+        def loseConnection(self):
+            if self.closing:
+                inotify.INotify.loseConnection(self)
+
+        def close(self):
+            self.closing = True
+            self.loseConnection()
+
 
 def certifyIcon(data):
     if len(data) > conf.MAX_GIF_SIZE:
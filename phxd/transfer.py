@@ -1,11 +1,25 @@
+from twisted.internet import defer, reactor, threads
+
 from phxd.utils import HLDecodeConst
 
-from struct import unpack
+from collections import deque
+from struct import Struct
+import logging
 import time
 
 
+_FILP_HEADER = Struct("!LHLLLLH")
+_FORK_HEADER = Struct("!4L")
+
+
 class HLTransfer:
 
+    __slots__ = ('id', 'file', 'total', 'transferred', 'offset', 'started', 'startTime', 'lastActivity', 'incoming', 'owner',
+                 'rate', 'rateBytes', 'rateStart')
+
+    # How often (in seconds) the current transfer rate is sampled.
+    RATE_WINDOW = 1.0
+
     def __init__(self, id, file, incoming):
         self.id = id
         self.file = file
@@ -18,6 +32,9 @@ class HLTransfer:
         self.incoming = incoming
         # this is really only useful for the server
         self.owner = 0
+        self.rate = 0
+        self.rateBytes = 0
+        self.rateStart = self.lastActivity
 
     def isIncoming(self):
         return self.incoming
@@ -32,6 +49,19 @@ class HLTransfer:
             return int(float(self.transferred) / elapsed)
         return 0
 
+    def getCurrentBPS(self):
+        """ Returns the speed (in BPS) of this transfer over the last sample window. """
+        self.sampleRate(time.time())
+        return self.rate
+
+    def sampleRate(self, now):
+        """ Updates the current rate once per RATE_WINDOW. Called whenever data moves, and when the rate is asked for. """
+        elapsed = now - self.rateStart
+        if elapsed >= self.RATE_WINDOW:
+            self.rate = int((self.transferred - self.rateBytes) / elapsed)
+            self.rateBytes = self.transferred
+            self.rateStart = now
+
     def isComplete(self):
         """ Returns True if all data has been sent or received. """
         return self.transferred >= self.total
@@ -56,13 +86,70 @@ class HLTransfer:
 
 class HLOutgoingTransfer(HLTransfer):
 
+    __slots__ = ('resume', 'options', 'stream', 'segments', 'segment', 'reader', 'mapped')
+
     READ_SIZE = 2 ** 14
+    READAHEAD_SIZE = 2 ** 16
+    MMAP_SIZE = 2 ** 18
+    SENDFILE_SIZE = 2 ** 20
 
     def __init__(self, id, file, resume, options):
         HLTransfer.__init__(self, id, file, False)
         self.resume = resume
+        self.options = options
         self.total = self.file.streamSize(resume, options)
         self.stream = self.file.stream(resume, options, self.READ_SIZE)
+        self.segments = None
+        self.segment = None
+        self.reader = None
+        self.mapped = False
+
+    def enableMmap(self):
+        """ Switches this transfer to handing out fork data as memoryviews of the mapped fork files (see HLFile.stream).
+        Must be called before anything has been sent. """
+        self.mapped = True
+        self.stream = self.file.stream(self.resume, self.options, self.MMAP_SIZE, mapped=True)
+
+    def enableReadAhead(self, depth):
+        """ Switches this transfer to reading its data from a HLFileReader, which keeps up to depth chunks
+        read ahead from the reactor's thread pool. Must be called before anything has been sent. """
+        if not self.mapped:
+            self.stream = self.file.stream(self.resume, self.options, self.READAHEAD_SIZE)
+        self.reader = HLFileReader(self.stream, depth)
+        self.stream = None
+
+    def enableSendfile(self):
+        """ Switches this transfer from handing out data chunks to handing out segments (see nextSegment),
+        so fork data can be sent with sendfile. Must be called before anything has been sent. """
+        self.stream = None
+        self.segments = self.file.segments(self.resume, self.options)
+
+    def nextSegment(self):
+        """ Returns the next thing to send: either bytes to be written, or a (fileno, offset, count) tuple
+        of file data to be sent directly. Returns None when there is nothing left. """
+        self.lastActivity = time.time()
+        # Forks with nothing left to send (empty, or already sent before a resume) have no body to send.
+        while (self.segment is None) or ((not isinstance(self.segment, bytes)) and (self.segment[2] <= 0)):
+            try:
+                self.segment = next(self.segments)
+            except StopIteration:
+                self.segment = None
+                return None
+        if isinstance(self.segment, bytes):
+            return self.segment
+        fork, offset, count = self.segment
+        return (self.file.fileno(fork), offset, min(count, self.SENDFILE_SIZE))
+
+    def segmentSent(self, size):
+        """ Records that size bytes of the current segment have been sent. """
+        self.transferred += size
+        self.sampleRate(self.lastActivity)
+        if isinstance(self.segment, bytes):
+            self.segment = None
+        else:
+            fork, offset, count = self.segment
+            count -= size
+            self.segment = (fork, offset + size, count) if count > 0 else None
 
     def overallPercent(self):
         # TODO: this doesn't take into account previous partial transfers
@@ -71,20 +158,193 @@ class HLOutgoingTransfer(HLTransfer):
         return 0
 
     def getDataChunk(self):
-        """ Returns the next chunk of data to be sent out. """
+        """ Returns the next chunk of data to be sent out, or b'' when there is nothing left. When reading ahead,
+        returns None if the next chunk has not been read yet; the reader's notify method says when it has. """
         self.lastActivity = time.time()
+        if self.reader is not None:
+            data = self.reader.read()
+            if data:
+                self.transferred += len(data)
+                self.sampleRate(self.lastActivity)
+            return data
         try:
             data = next(self.stream)
             self.transferred += len(data)
+            self.sampleRate(self.lastActivity)
             return data
         except StopIteration:
             return b''
 
     def finish(self):
         """ Called when the download connection closes. """
+        if self.reader is not None:
+            return self.reader.close().addCallback(lambda _: self.file.close())
         self.file.close()
 
 
+class HLFileReader:
+    """ Reads a download stream ahead of the connection from the reactor's thread pool, so slow disks don't block
+    the reactor. At most one read is in flight, and at most depth chunks are held (two makes a double buffer). """
+
+    def __init__(self, stream, depth=2):
+        self.stream = stream
+        self.depth = max(1, depth)
+        self.ready = deque()
+        self.reading = False
+        self.done = False
+        self.error = None
+        self.waiter = None
+        self.closed = None
+        self.fill()
+
+    def read(self):
+        """ Returns the next chunk, b'' at the end of the stream (or after an error), or None if the next chunk
+        is still being read. Called from the reactor thread. """
+        if self.ready:
+            data = self.ready.popleft()
+        elif self.done:
+            data = b''
+        else:
+            data = None
+        self.fill()
+        return data
+
+    def notify(self, callback):
+        """ Calls callback (once) when read has something new to return. """
+        self.waiter = callback
+
+    def close(self):
+        """ Returns a Deferred that fires once no read is in flight. Nothing is read after this is called. """
+        if self.closed is None:
+            self.closed = defer.Deferred()
+            self.done = True
+            self.ready.clear()
+            self.waiter = None
+            if not self.reading:
+                self.closed.callback(None)
+        return self.closed
+
+    def fill(self):
+        if not (self.reading or self.done) and (len(self.ready) < self.depth):
+            self.reading = True
+            reactor.callInThread(self._readAhead)
+
+    def _readAhead(self):
+        # Runs in a pool thread; the stream is only ever advanced by one read at a time.
+        try:
+            data = next(self.stream, b'')
+        except Exception as e:
+            reactor.callFromThread(self._failed, e)
+            return
+        reactor.callFromThread(self._chunkRead, data)
+
+    def _chunkRead(self, data):
+        self.reading = False
+        if self.closed is not None:
+            self.closed.callback(None)
+            return
+        if data:
+            self.ready.append(data)
+        else:
+            self.done = True
+        self.fill()
+        self._wake()
+
+    def _failed(self, e):
+        logging.error("[xfer] error reading download: %s", e)
+        self.error = e
+        self.reading = False
+        self.done = True
+        if self.closed is not None:
+            self.closed.callback(None)
+            return
+        self._wake()
+
+    def _wake(self):
+        if self.waiter is not None:
+            waiter = self.waiter
+            self.waiter = None
+            waiter()
+
+
+class HLFileWriter:
+    """ Writes upload data to a HLFile from the reactor's thread pool, in order, so slow disks don't block the
+    reactor. Pauses the producer (normally the upload's transport) while too much data is waiting to be written. """
+
+    HIGH_WATER = 2 ** 20
+    LOW_WATER = 2 ** 18
+
+    def __init__(self, file, producer):
+        self.file = file
+        self.producer = producer
+        self.pending = deque()
+        self.pendingBytes = 0
+        self.running = False
+        self.paused = False
+        self.error = None
+        self.closed = None
+
+    def write(self, fork, data):
+        """ Queues data to be written to the specified fork. Called from the reactor thread. """
+        if self.error is not None:
+            return
+        self.pending.append((fork, data))
+        self.pendingBytes += len(data)
+        if not self.running:
+            self.running = True
+            reactor.callInThread(self._drain)
+        if (self.pendingBytes > self.HIGH_WATER) and not self.paused:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def close(self):
+        """ Returns a Deferred that fires once everything queued has been written and the file has been closed. """
+        if self.closed is None:
+            self.closed = defer.Deferred()
+            if not self.running:
+                self._close()
+        return self.closed
+
+    def _drain(self):
+        # Runs in a pool thread. The deque is only appended to by the reactor thread, and only popped here.
+        while self.pending:
+            fork, data = self.pending.popleft()
+            try:
+                self.file.write(fork, data)
+            except Exception as e:
+                reactor.callFromThread(self._failed, e)
+                return
+            reactor.callFromThread(self._written, len(data))
+        reactor.callFromThread(self._idle)
+
+    def _written(self, size):
+        self.pendingBytes -= size
+        if self.paused and (self.pendingBytes < self.LOW_WATER):
+            self.paused = False
+            self.producer.resumeProducing()
+
+    def _idle(self):
+        if self.pending and self.error is None:
+            reactor.callInThread(self._drain)
+            return
+        self.running = False
+        if self.closed is not None:
+            self._close()
+
+    def _failed(self, e):
+        logging.error("[xfer] error writing %s: %s", self.file.dataPath, e)
+        self.error = e
+        self.pending.clear()
+        self.pendingBytes = 0
+        self.running = False
+        self.producer.stopProducing()
+        if self.closed is not None:
+            self._close()
+
+    def _close(self):
+        threads.deferToThread(self.file.close).addErrback(logging.error).chainDeferred(self.closed)
+
+
 STATE_FILP = 0
 STATE_HEADER = 1
 STATE_FORK = 2
@@ -92,16 +352,21 @@ STATE_FORK = 2
 
 class HLIncomingTransfer(HLTransfer):
 
+    __slots__ = ('initialSize', 'buffer', 'state', 'forkCount', 'currentFork', 'forkName', 'forkSize', 'forkOffset', 'writer')
+
     def __init__(self, id, file):
         HLTransfer.__init__(self, id, file, True)
         self.initialSize = self.file.size()
-        self.buffer = b""
+        # Only used to collect FILP and fork headers that arrive split across reads.
+        self.buffer = bytearray()
         self.state = STATE_FILP
         self.forkCount = 0
         self.currentFork = 0
         self.forkName = ''
         self.forkSize = 0
         self.forkOffset = 0
+        # If set, a HLFileWriter that fork data is handed to instead of being written here.
+        self.writer = None
 
     def overallPercent(self):
         done = self.initialSize + self.transferred
@@ -110,43 +375,66 @@ class HLIncomingTransfer(HLTransfer):
             return int((float(done) / float(total)) * 100)
         return 0
 
+    def _readHeader(self, view, pos, size):
+        """ Returns (header, newPos), where header is None if the rest of it has not arrived yet. """
+        if not self.buffer and (len(view) - pos) >= size:
+            return (view[pos:pos + size], pos + size)
+        take = min(size - len(self.buffer), len(view) - pos)
+        self.buffer += view[pos:pos + take]
+        pos += take
+        if len(self.buffer) < size:
+            return (None, pos)
+        header = bytes(self.buffer)
+        self.buffer = bytearray()
+        return (header, pos)
+
     def parseData(self, data):
-        """ Called when data is received from the upload connection. Writes any data received for the DATA fork out to the specified file. """
-        self.buffer += data
+        """ Called when data is received from the upload connection. Writes any data received for the DATA fork out to the specified file.
+        Fork data is passed along as views into data, which is never copied. """
         self.transferred += len(data)
         self.lastActivity = time.time()
+        self.sampleRate(self.lastActivity)
+        view = memoryview(data)
+        pos = 0
         while True:
             if self.state == STATE_FILP:
-                if len(self.buffer) < 24:
+                (header, pos) = self._readHeader(view, pos, _FILP_HEADER.size)
+                if header is None:
                     return False
-                (proto, vers, _r1, _r2, _r3, _r4, self.forkCount) = unpack("!LHLLLLH", self.buffer[0:24])
-                self.buffer = self.buffer[24:]
+                (proto, vers, _r1, _r2, _r3, _r4, self.forkCount) = _FILP_HEADER.unpack(header)
                 self.state = STATE_HEADER
             elif self.state == STATE_HEADER:
-                if len(self.buffer) < 16:
+                (header, pos) = self._readHeader(view, pos, _FORK_HEADER.size)
+                if header is None:
                     return False
-                (self.currentFork, _r1, _r2, self.forkSize) = unpack("!4L", self.buffer[0:16])
-                self.buffer = self.buffer[16:]
+                (self.currentFork, _r1, _r2, self.forkSize) = _FORK_HEADER.unpack(header)
                 self.forkName = HLDecodeConst(self.currentFork)
                 self.forkOffset = 0
                 self.state = STATE_FORK
             elif self.state == STATE_FORK:
-                remaining = self.forkSize - self.forkOffset
-                if len(self.buffer) < remaining:
+                size = min(self.forkSize - self.forkOffset, len(view) - pos)
+                if size > 0:
+                    self.writeFork(self.forkName, view[pos:pos + size])
+                    self.forkOffset += size
+                    pos += size
+                if self.forkOffset < self.forkSize:
                     # We don't have the rest of the fork yet.
-                    self.file.write(self.forkName, self.buffer)
-                    self.forkOffset += len(self.buffer)
-                    self.buffer = b""
                     return False
-                else:
-                    # We got the rest of the current fork.
-                    self.file.write(self.forkName, self.buffer[0:remaining])
-                    self.buffer = self.buffer[remaining:]
-                    self.forkCount -= 1
-                    if self.forkCount <= 0:
-                        return True
-                    self.state = STATE_HEADER
+                # We got the rest of the current fork.
+                self.forkCount -= 1
+                if self.forkCount <= 0:
+                    return True
+                self.state = STATE_HEADER
+
+    def writeFork(self, fork, data):
+        if self.writer is not None:
+            self.writer.write(fork, data)
+        else:
+            self.file.write(fork, data)
 
     def finish(self):
-        """ Called when the upload connection closes. If the upload is complete, renames the file, stripping off the .hpf extension. """
+        """ Called when the upload connection closes. If the upload is complete, renames the file, stripping off the .hpf extension.
+        Returns a Deferred if the file is still being written by a HLFileWriter. """
+        if self.writer is not None:
+            return self.writer.close()
         self.file.close()
@@ -1,10 +1,23 @@
+from phxd.metadata import NO_METADATA, metadataStore
 from phxd.utils import HLCharConst, HLDecodeConst
 
+from collections import OrderedDict
 from datetime import datetime
-from struct import pack, unpack
+from struct import Struct, pack, unpack
 import io
+import mmap
 import os
 import re
+import shutil
+import threading
+
+
+# Precompiled codecs for the flattened structures below.
+_USER_HEADER = Struct("!4H")
+_USER_COLOR = Struct("!L")
+_RESUME_HEADER = Struct("!LH34xH")
+_RESUME_FORK = Struct("!4L")
+_FILE_HEADER = Struct("!5L")
 
 
 class HLException (Exception):
@@ -64,6 +77,8 @@ class HLMail (object):
 class HLUser:
     """ Stores user information, along with an associated HLAccount object. Also flattenable for use in userlist packet objects. """
 
+    __slots__ = ('uid', 'ip', '_nick', 'icon', 'status', 'gif', 'color', 'account', 'away', 'lastPacketTime', 'valid')
+
     def __init__(self, uid=0, addr=""):
         self.uid = uid
         self.ip = addr
@@ -109,17 +124,18 @@ class HLUser:
     def flatten(self):
         """ Flattens the user information into a packed structure to send in a HLObject. """
         nick_utf8 = self.nick.encode('utf-8', 'replace')
-        data = pack("!4H", self.uid, self.icon, self.status, len(nick_utf8))
-        data += nick_utf8
+        data = _USER_HEADER.pack(self.uid, self.icon, self.status, len(nick_utf8)) + nick_utf8
         # this is an avaraline extension for nick coloring
         if self.color >= 0:
-            data += pack("!L", self.color)
+            data += _USER_COLOR.pack(self.color)
         return data
 
 
 class HLChat:
     """ Stores information about a private chat. """
 
+    __slots__ = ('id', 'users', 'invites', 'subject')
+
     def __init__(self, id=0):
         self.id = id
         self.users = []
@@ -190,26 +206,105 @@ class HLResumeData:
 
     def flatten(self):
         """ Flattens the resume information into a packed structure to send in a HLObject. """
-        data = pack("!LH", HLCharConst("RFLT"), 1)
-        data += bytes(34)
-        data += pack("!H", len(self.forkOffsets.keys()))
-        for forkType in self.forkOffsets.keys():
-            data += pack("!4L", forkType, self.forkOffsets[forkType], 0, 0)
-        return data
+        data = bytearray(_RESUME_HEADER.size + (_RESUME_FORK.size * len(self.forkOffsets)))
+        _RESUME_HEADER.pack_into(data, 0, HLCharConst("RFLT"), 1, len(self.forkOffsets))
+        offset = _RESUME_HEADER.size
+        for forkType, forkOffset in self.forkOffsets.items():
+            _RESUME_FORK.pack_into(data, offset, forkType, forkOffset, 0, 0)
+            offset += _RESUME_FORK.size
+        return bytes(data)
 
     def totalOffset(self):
         return sum(self.forkOffsets.values())
 
 
+class HLChunkCache:
+    """ Process-wide LRU cache of file data in CHUNK_SIZE pieces, keyed by (path, fork, mtime, offset), so a file
+    being downloaded by many users at once is read from disk once. Holds at most budget bytes; a budget of 0
+    disables it. Safe to use from the reactor thread and pool threads at once. """
+
+    CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.size = 0
+        self.chunks = OrderedDict()
+        # Keys being read from disk, mapped to an Event set once they're done, so concurrent misses read once.
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setBudget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def fetch(self, key, load):
+        """ Returns the chunk for key, calling load() to read it on a miss. """
+        while True:
+            with self.lock:
+                data = self.chunks.get(key)
+                if data is not None:
+                    self.chunks.move_to_end(key)
+                    self.hits += 1
+                    return data
+                loading = self.loading.get(key)
+                if loading is None:
+                    loading = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is reading this chunk; wait for them, then look again.
+            loading.wait()
+        try:
+            data = load()
+            with self.lock:
+                if data and (len(data) <= self.budget):
+                    self.chunks[key] = data
+                    self.size += len(data)
+                    self._evict()
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+        return data
+
+    def _evict(self):
+        while self.size > self.budget:
+            (key, data) = self.chunks.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def stats(self):
+        return (self.hits, self.misses, self.evictions, self.size)
+
+
+chunkCache = HLChunkCache()
+
+
 class HLFile:
+    """ A file in the file area. Type, creator, and comment are kept in metadataStore once it has been opened,
+    otherwise in ._name.TYPE, ._name.CREATOR, and ._name.COMMENT files next to the file. """
 
-    def __init__(self, path):
+    def __init__(self, path, metadata=None):
         head, self.name = os.path.split(path)
         self.dataPath = path
         self.dataFile = None
         self.rsrcPath = os.path.join(head, '._' + self.name)
         self.rsrcFile = None
         self.info = io.BytesIO()
+        # The HLMetadata for this file if already known (from a bulk lookup, say), otherwise looked up when needed.
+        self.metadata = metadata
+
+    def getMetadata(self):
+        if self.metadata is None:
+            self.metadata = metadataStore.get(self.dataPath) or NO_METADATA
+        return self.metadata
+
+    def setMetadata(self, field, value):
+        metadataStore.set(self.dataPath, field, value)
+        self.metadata = None
 
     def isdir(self):
         return os.path.isdir(self.dataPath)
@@ -229,19 +324,20 @@ class HLFile:
             return total
 
     def rename(self, newPath):
+        """ Renames or moves this file (or folder). Moves across devices copy everything, so they can take a while. """
         self.close()
         head, name = os.path.split(newPath)
         newRsrc = os.path.join(head, '._' + name)
         if os.path.exists(self.dataPath):
-            os.rename(self.dataPath, newPath)
+            shutil.move(self.dataPath, newPath)
         if os.path.exists(self.rsrcPath):
-            os.rename(self.rsrcPath, newRsrc)
-        if os.path.exists(self.rsrcPath + '.TYPE'):
-            os.rename(self.rsrcPath + '.TYPE', newRsrc + '.TYPE')
-        if os.path.exists(self.rsrcPath + '.CREATOR'):
-            os.rename(self.rsrcPath + '.CREATOR', newRsrc + '.CREATOR')
-        if os.path.exists(self.rsrcPath + '.COMMENT'):
-            os.rename(self.rsrcPath + '.COMMENT', newRsrc + '.COMMENT')
+            shutil.move(self.rsrcPath, newRsrc)
+        if metadataStore.isOpen():
+            metadataStore.rename(self.dataPath, newPath)
+        else:
+            for suffix in ('.TYPE', '.CREATOR', '.COMMENT'):
+                if os.path.exists(self.rsrcPath + suffix):
+                    shutil.move(self.rsrcPath + suffix, newRsrc + suffix)
         self.dataPath = newPath
         self.rsrcPath = newRsrc
 
@@ -301,18 +397,33 @@ class HLFile:
             self.setCreator(HLDecodeConst(creatorCode))
         self.info = io.BytesIO()
 
+    def isSameDevice(self, path):
+        """ Returns True if this file could be renamed to path without copying it. """
+        return os.stat(self.dataPath).st_dev == os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+
     def delete(self):
+        """ Deletes this file, or this folder and everything in it. """
         self.close()
+        if os.path.isdir(self.dataPath):
+            # First, recursively delete everything inside the directory, then the directory itself.
+            for (root, dirs, files) in os.walk(self.dataPath, topdown=False):
+                for name in files:
+                    os.unlink(os.path.join(root, name))
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+            os.rmdir(self.dataPath)
+            metadataStore.delete(self.dataPath)
+            return
         if os.path.exists(self.dataPath):
             os.unlink(self.dataPath)
         if os.path.exists(self.rsrcPath):
             os.unlink(self.rsrcPath)
-        if os.path.exists(self.rsrcPath + '.TYPE'):
-            os.unlink(self.rsrcPath + '.TYPE')
-        if os.path.exists(self.rsrcPath + '.CREATOR'):
-            os.unlink(self.rsrcPath + '.CREATOR')
-        if os.path.exists(self.rsrcPath + '.COMMENT'):
-            os.unlink(self.rsrcPath + '.COMMENT')
+        if metadataStore.isOpen():
+            metadataStore.delete(self.dataPath)
+        else:
+            for suffix in ('.TYPE', '.CREATOR', '.COMMENT'):
+                if os.path.exists(self.rsrcPath + suffix):
+                    os.unlink(self.rsrcPath + suffix)
 
     def resumeData(self):
         resume = HLResumeData()
@@ -327,6 +438,8 @@ class HLFile:
             return HLCharConst("fldr")
         elif self.name.endswith(".hpf"):
             return HLCharConst("HTft")
+        elif metadataStore.isOpen():
+            return HLCharConst((self.getMetadata().type or "????")[:4])
         else:
             try:
                 return HLCharConst(open(self.rsrcPath + '.TYPE', 'r').read(4))
@@ -338,6 +451,8 @@ class HLFile:
             return 0
         elif self.name.endswith(".hpf"):
             return HLCharConst("HTLC")
+        elif metadataStore.isOpen():
+            return HLCharConst((self.getMetadata().creator or "????")[:4])
         else:
             try:
                 return HLCharConst(open(self.rsrcPath + '.CREATOR', 'r').read(4))
@@ -345,6 +460,8 @@ class HLFile:
                 return HLCharConst("????")
 
     def getComment(self):
+        if metadataStore.isOpen():
+            return self.getMetadata().comment or ""
         try:
             with open(self.rsrcPath + '.COMMENT', 'r') as f:
                 return f.read()
@@ -352,21 +469,30 @@ class HLFile:
             return ""
 
     def setType(self, typeCode):
+        if metadataStore.isOpen():
+            self.setMetadata('type', typeCode)
+            return
         with open(self.rsrcPath + '.TYPE', 'w') as f:
             f.write(typeCode)
 
     def setCreator(self, creatorCode):
+        if metadataStore.isOpen():
+            self.setMetadata('creator', creatorCode)
+            return
         with open(self.rsrcPath + '.CREATOR', 'w') as f:
             f.write(creatorCode)
 
     def setComment(self, comment):
+        if metadataStore.isOpen():
+            self.setMetadata('comment', comment)
+            return
         with open(self.rsrcPath + '.COMMENT', 'w') as f:
             f.write(comment)
 
     def flatten(self):
         namedata = self.name.encode('utf-8')
         size = self.size()
-        return pack("!5L", self.getType(), self.getCreator(), size, size, len(namedata)) + namedata
+        return _FILE_HEADER.pack(self.getType(), self.getCreator(), size, size, len(namedata)) + namedata
 
     def streamSize(self, resume, options):
         if options == 2:
@@ -380,29 +506,113 @@ class HLFile:
             total += 16 + remaining
         return total
 
-    def stream(self, resume, options, chunkSize=16384):
+    def cachedChunks(self, fork, offset):
+        """ Yields the specified fork from offset to the end, going through chunkCache. """
+        path = self.dataPath if fork == "DATA" else self.rsrcPath
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        chunkSize = chunkCache.CHUNK_SIZE
+        pos = offset - (offset % chunkSize)
+        while True:
+            chunk = chunkCache.fetch((path, fork, mtime, pos), lambda: self.readChunk(fork, pos, chunkSize))
+            data = chunk[offset - pos:] if offset > pos else chunk
+            if data:
+                yield data
+            if len(chunk) < chunkSize:
+                break
+            pos += chunkSize
+
+    def mappedChunks(self, fork, offset, remaining, chunkSize):
+        """ Yields memoryviews of remaining bytes of the specified fork starting at offset, from a read-only mapping.
+        Stops early if the file is truncated, since touching pages past the end of the file would raise SIGBUS. """
+        if remaining <= 0:
+            return
+        fd = self.fileno(fork)
+        end = offset + remaining
+        mapping = mmap.mmap(fd, end, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        try:
+            pos = offset
+            while pos < end:
+                size = min(chunkSize, end - pos)
+                if os.fstat(fd).st_size < pos + size:
+                    break
+                if hasattr(mmap, 'MADV_WILLNEED'):
+                    # Start paging in this chunk now, so it's less likely to fault on the reactor thread.
+                    start = pos - (pos % mmap.PAGESIZE)
+                    mapping.madvise(mmap.MADV_WILLNEED, start, pos + size - start)
+                yield view[pos:pos + size]
+                pos += size
+        finally:
+            try:
+                view.release()
+                mapping.close()
+            except BufferError:
+                # Slices are still queued in the transport; the mapping goes away once they're released.
+                pass
+
+    def readChunk(self, fork, pos, size):
+        self.seek(fork, pos)
+        return self.read(fork, size) or b""
+
+    def fileno(self, fork):
+        """ Returns the file descriptor for the specified fork, opening it for reading if necessary. """
+        if fork == "DATA":
+            if self.dataFile is None:
+                self.dataFile = open(self.dataPath, "rb")
+            return self.dataFile.fileno()
+        elif fork == "MACR":
+            if self.rsrcFile is None:
+                self.rsrcFile = open(self.rsrcPath, "rb")
+            return self.rsrcFile.fileno()
+
+    def segments(self, resume, options):
+        """ Yields the pieces of a download: flattened headers as bytes, and the body of each fork
+        as a (fork, offset, length) tuple for the caller to read or sendfile. """
         if options == 2:
             # File previews seem to just send raw data forks, no flattened fork data.
             forks = ['DATA']
         else:
             forks = self.forks()
             namedata = self.name.encode('utf-8')
-            yield pack("!LHLLLLH", HLCharConst("FILP"), 1, 0, 0, 0, 0, len(forks) + 1)
-            yield pack("!4L", HLCharConst("INFO"), 0, 0, 74 + len(namedata))
-            yield pack("!5L", HLCharConst("AMAC"), self.getType(), self.getCreator(), 0, 0)
-            yield bytes(32)
-            yield pack("!HHL", 0, 0, 0)  # date created
-            yield pack("!HHL", 0, 0, 0)  # date modified
-            yield pack("!HH", 0, len(namedata))
-            yield namedata
-            yield pack("!H", 0)
+            yield b"".join((
+                pack("!LHLLLLH", HLCharConst("FILP"), 1, 0, 0, 0, 0, len(forks) + 1),
+                pack("!4L", HLCharConst("INFO"), 0, 0, 74 + len(namedata)),
+                pack("!5L", HLCharConst("AMAC"), self.getType(), self.getCreator(), 0, 0),
+                bytes(32),
+                pack("!HHL", 0, 0, 0),  # date created
+                pack("!HHL", 0, 0, 0),  # date modified
+                pack("!HH", 0, len(namedata)),
+                namedata,
+                pack("!H", 0),
+            ))
         for fork in forks:
             offset = resume.forkOffset(HLCharConst(fork))
             remaining = self.size(fork) - offset
             if options != 2:
                 yield pack("!4L", HLCharConst(fork), 0, 0, remaining)
-            self.seek(fork, offset)
-            data = self.read(fork, chunkSize)
-            while data:
-                yield data
+            yield (fork, offset, remaining)
+
+    def stream(self, resume, options, chunkSize=16384, mapped=False):
+        """ Yields the data for a download. If mapped is True, fork data is yielded as memoryviews of the mapped
+        fork files rather than being read, and stops at the fork sizes given in the fork headers. """
+        for segment in self.segments(resume, options):
+            if isinstance(segment, bytes):
+                yield segment
+            elif mapped:
+                fork, offset, remaining = segment
+                for data in self.mappedChunks(fork, offset, remaining, chunkSize):
+                    yield data
+            elif chunkCache.budget > 0:
+                fork, offset, remaining = segment
+                for data in self.cachedChunks(fork, offset):
+                    yield data
+            else:
+                fork, offset, remaining = segment
+                self.seek(fork, offset)
                 data = self.read(fork, chunkSize)
+                while data:
+                    yield data
+                    data = self.read(fork, chunkSize)
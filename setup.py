@@ -27,6 +27,7 @@ setup(
     scripts=[
         'scripts/phxd',
         'scripts/phx',
+        'scripts/phxd-import-metadata',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,89 @@
+from phxd.server.config import conf
+from phxd.server.files import HLFileServer, HLTransferShaper, TokenBucket
+from phxd.types import HLFile, HLResumeData, HLUser
+
+from types import SimpleNamespace
+import os
+import tempfile
+import unittest
+
+
+class FakeDownload:
+    """ Stands in for a download's HLTransferProtocol, recording what the shaper lets it send. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.sent = []
+
+    def produce(self, limit=None):
+        self.sent.append(limit)
+        return limit
+
+
+class TransferShaperTests(unittest.TestCase):
+
+    def setUp(self):
+        self.shaper = HLTransferShaper()
+
+    def testThrottledDownloadWaits(self):
+        throttled = TokenBucket(1000)
+        throttled.tokens = 0
+        conn = FakeDownload([throttled])
+        self.shaper.schedule(conn)
+        self.assertEqual(conn.sent, [])
+        self.assertEqual(list(self.shaper.waiting), [conn])
+
+    def testWaitingDownloadDoesNotHoldBackOthers(self):
+        shared = TokenBucket(10 ** 8)
+        throttled = TokenBucket(1000)
+        throttled.tokens = 0
+        slow = FakeDownload([shared, throttled])
+        fast = FakeDownload([shared])
+        self.shaper.schedule(slow)
+        self.shaper.schedule(fast)
+        self.assertEqual(list(self.shaper.waiting), [slow])
+        self.assertEqual(len(fast.sent), 1)
+
+
+class FakeServer:
+
+    def __init__(self, users):
+        self.users = dict((user.uid, user) for user in users)
+
+    def getUser(self, uid):
+        return self.users.get(uid)
+
+    def sendPacket(self, packet, to=None):
+        pass
+
+
+class AdmissionQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = SimpleNamespace(MAX_XFERS=conf.MAX_XFERS, MAX_XFERS_PER_USER=conf.MAX_XFERS_PER_USER)
+        conf.update(SimpleNamespace(MAX_XFERS=10, MAX_XFERS_PER_USER=1))
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        self.users = [HLUser(1, "127.0.0.1"), HLUser(2, "127.0.0.1")]
+        self.fileserver = HLFileServer(FakeServer(self.users))
+
+    def tearDown(self):
+        self.fileserver.tickle.stop()
+        conf.update(self.saved)
+        os.unlink(self.path)
+
+    def download(self, user):
+        return self.fileserver.addDownload(user, HLFile(self.path), HLResumeData(), 0)
+
+    def testUserAtLimitDoesNotBlockOthers(self):
+        first = self.download(self.users[0])
+        second = self.download(self.users[0])
+        other = self.download(self.users[1])
+        self.assertEqual(first.queuePosition, 0)
+        self.assertEqual(second.queuePosition, 1)
+        self.assertEqual(other.queuePosition, 0)
+        self.assertEqual(self.fileserver.active, set([first, other]))
+
+
+if __name__ == '__main__':
+    unittest.main()
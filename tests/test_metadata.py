@@ -0,0 +1,67 @@
+from phxd.constants import *
+from phxd.metadata import HLMetadataStore, metadataStore
+from phxd.packet import HLPacket
+from phxd.server.handlers.files import handleFileSetInfo
+from phxd.server.files import HLFileJobs
+from phxd.types import HLAccount, HLFile, HLUser
+from phxd.utils import HLCharConst
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeServer:
+
+    def __init__(self):
+        self.filejobs = HLFileJobs()
+        self.sent = []
+
+    def fileChanged(self, path):
+        pass
+
+    def sendPacket(self, packet, to=None):
+        self.sent.append(packet)
+
+
+class MetadataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'file')
+        with open(self.path, 'wb') as f:
+            f.write(b'data')
+
+    def tearDown(self):
+        if metadataStore.isOpen():
+            metadataStore.db.close()
+            metadataStore.db = None
+        shutil.rmtree(self.root)
+
+    def testRenameToSamePath(self):
+        store = HLMetadataStore()
+        store.open(':memory:')
+        store.set(self.path, 'type', 'TEXT')
+        store.set(self.path, 'creator', 'ttxt')
+        store.rename(self.path, self.path)
+        self.assertEqual(store.get(self.path), ('TEXT', 'ttxt', None))
+
+    def testSetCommentKeepsTypeAndCreator(self):
+        metadataStore.open(os.path.join(self.root, 'meta.db'))
+        file = HLFile(self.path)
+        file.setType('TEXT')
+        file.setCreator('ttxt')
+        user = HLUser(1)
+        user.account = HLAccount('admin')
+        user.account.fileRoot = self.root
+        packet = HLPacket(HTLC_HDR_FILE_SETINFO)
+        packet.addString(DATA_FILENAME, 'file')
+        packet.addString(DATA_COMMENT, 'a comment')
+        server = FakeServer()
+        handleFileSetInfo(server, user, packet)
+        self.assertEqual(server.sent[0].flags, 0)
+        file = HLFile(self.path)
+        self.assertEqual(file.getComment(), 'a comment')
+        self.assertEqual(file.getType(), HLCharConst('TEXT'))
+        self.assertEqual(file.getCreator(), HLCharConst('ttxt'))
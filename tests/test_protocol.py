@@ -0,0 +1,36 @@
+from twisted.internet.testing import StringTransport
+
+from phxd.protocol import HLProtocol
+
+import unittest
+
+
+class FakeFactory:
+
+    def notifyConnect(self, conn):
+        pass
+
+
+class OutgoingQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.conn = HLProtocol()
+        self.conn.factory = FakeFactory()
+        self.conn.makeConnection(self.transport)
+
+    def testLoseConnectionWhilePaused(self):
+        self.conn.writeData(b'first', immediate=True)
+        # What the transport does once its write buffer is full.
+        self.conn.pauseProducing()
+        self.conn.writeData(b'second', immediate=True)
+        self.assertEqual(self.transport.value(), b'first')
+        self.conn.loseConnection()
+        # Everything queued is handed to the transport, which must not be left waiting on us to close.
+        self.assertEqual(self.transport.value(), b'firstsecond')
+        self.assertIsNone(self.transport.producer)
+        self.assertTrue(self.transport.disconnecting)
+
+
+if __name__ == '__main__':
+    unittest.main()
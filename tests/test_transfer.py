@@ -0,0 +1,138 @@
+from phxd.protocol import HLTransferProtocol
+from phxd.transfer import HLOutgoingTransfer
+from phxd.types import HLFile, HLResumeData
+from phxd.utils import HLCharConst
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+
+class FakeTransport:
+    """ Just enough of a TCP transport for HLTransferProtocol to send a download over a real socket with sendfile. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.producer = None
+        self.closed = False
+
+    def getHandle(self):
+        return self.sock
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def startWriting(self):
+        pass
+
+    def loseConnection(self):
+        self.closed = True
+
+
+class SendfileDownloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'file')
+        (self.sender, self.receiver) = socket.socketpair()
+        self.sender.setblocking(False)
+        self.receiver.setblocking(False)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        shutil.rmtree(self.root)
+
+    def makeFile(self, data, rsrc):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        with open(os.path.join(self.root, '._file'), 'wb') as f:
+            f.write(rsrc)
+
+    def drain(self):
+        data = b''
+        try:
+            while True:
+                data += self.receiver.recv(65536)
+        except BlockingIOError:
+            return data
+
+    def expected(self, resume):
+        """ Returns what the download sends without sendfile. """
+        xfer = HLOutgoingTransfer(1, HLFile(self.path), resume, 0)
+        data = b''
+        chunk = xfer.getDataChunk()
+        while chunk:
+            data += chunk
+            chunk = xfer.getDataChunk()
+        xfer.finish()
+        return data
+
+    def download(self, resume):
+        xfer = HLOutgoingTransfer(1, HLFile(self.path), resume, 0)
+        proto = HLTransferProtocol()
+        proto.useSendfile = True
+        proto.transport = FakeTransport(self.sender)
+        proto.start(xfer)
+        self.assertIsNotNone(xfer.segments)
+        received = b''
+        while (proto.transport.producer is not None) and not proto.transport.closed:
+            proto.resumeProducing()
+            received += self.drain()
+        self.sender.shutdown(socket.SHUT_WR)
+        self.receiver.setblocking(True)
+        data = self.receiver.recv(65536)
+        while data:
+            received += data
+            data = self.receiver.recv(65536)
+        xfer.finish()
+        self.assertFalse(proto.transport.closed)
+        self.assertTrue(xfer.isComplete())
+        return received
+
+    def testEmptyDataFork(self):
+        self.makeFile(b'', os.urandom(100000))
+        resume = HLResumeData()
+        self.assertEqual(self.download(resume), self.expected(resume))
+
+    def testResumeWithFinishedFork(self):
+        self.makeFile(os.urandom(500), os.urandom(100000))
+        resume = HLResumeData()
+        resume.setForkOffset(HLCharConst("DATA"), 500)
+        resume.setForkOffset(HLCharConst("MACR"), 500)
+        self.assertEqual(self.download(resume), self.expected(resume))
+
+    def truncatedDownload(self, sendFirst):
+        """ Starts a download, sends sendFirst pieces of it, then shortens the file and sends the rest. """
+        self.makeFile(os.urandom(4 << 20), b'')
+        xfer = HLOutgoingTransfer(1, HLFile(self.path), HLResumeData(), 0)
+        proto = HLTransferProtocol()
+        proto.useSendfile = True
+        proto.transport = FakeTransport(self.sender)
+        proto.start(xfer)
+        for k in range(sendFirst):
+            proto.resumeProducing()
+            self.drain()
+        os.truncate(self.path, 1000)
+        while (proto.transport.producer is not None) and not proto.transport.closed:
+            proto.resumeProducing()
+            self.drain()
+        # The transport has to be rid of its producer too, or it never gets around to closing.
+        self.assertTrue(proto.transport.closed)
+        self.assertIsNone(proto.transport.producer)
+        self.assertFalse(xfer.isComplete())
+        xfer.finish()
+
+    def testTruncatedBeforeFork(self):
+        self.truncatedDownload(0)
+
+    def testTruncatedDuringFork(self):
+        self.truncatedDownload(2)